@@ -20,6 +20,9 @@ COORDINATES_FILENAME = "Swedish_location_coordinates.csv"
 EXPORT_CATEGORY_MAP = 'Category_map.csv'
 EXPORT_REGION_MAP = 'Region_map.csv'
 ENCODING = 'utf-16'
+# Removed from the numbers before their conversion, as in the scraper
+SWEDISH_NUMBER_NOISE = r"[\s\xa0%]"
+DELTA_FILE_PREFIX = "Company_delta " # Raw data files written by the refreshes of the scraper, with only the changed companies
 MAX_ROWS = -1  # Use -1 for all rows
 N_LAT_BINS = 14
 N_LONG_BINS = 6
@@ -1059,26 +1062,39 @@ Export = True
 
 def Read_data(folder, max_rows, earliest_year):
     # This function looks for .csv files in the folder, which are expected to contain the raw web-scraped data.
+    # The scraper can also write Parquet or Arrow files (--format): they are already typed, so they are read as they are.
+    # The delta files of the refreshes (--delta) contain only the changed companies. All the files are read oldest first,
+    # and the rows of the most recent crawl replace the ones with the same orgnr, whether it's a full crawl or a refresh.
     frames = [] # List of dataframes created out of each .csv
     earliest_year
     # Scan the folder to find all the files to be read
     df = pd.DataFrame()
-    for file in os.listdir(folder):
+    files = sorted(os.listdir(folder), key=lambda file: os.path.getmtime(os.path.join(folder, file)))
+    for file in files:
         if len(df) >= max_rows and max_rows != -1:
             break
         else:
-            if file.endswith('.csv'):
+            if file.endswith(('.csv', '.parquet', '.arrow')):
                 file_path = os.path.join(folder, file)
                 try:
-                    # Read the content of the CSV and put it in a dataframe
+                    # Read the content of the file and put it in a dataframe
                     print("Reading", file_path.split('\\')[-1])
-                    df = pd.read_csv(file_path, encoding=ENCODING, sep=';', on_bad_lines='skip', low_memory=False)
+                    if file.endswith('.parquet'):
+                        df = pd.read_parquet(file_path)
+                    elif file.endswith('.arrow'):
+                        df = pd.read_feather(file_path)
+                    else:
+                        df = pd.read_csv(file_path, encoding=ENCODING, sep=';', on_bad_lines='skip', low_memory=False, dtype={"orgnr": str})
+                    # The organisation numbers are text in every format, so that the rows of a delta file match those of any full file
+                    df["orgnr"] = df["orgnr"].astype(str)
                     frames.append(df)
                 except Exception as e:
                     print(f"Error reading {file}: {e}")
     # Merge all the dataframes
     print("Concatenating dataframes...")
     concatenated_raw_data = pd.concat(frames, ignore_index=True)
+    if any(file.startswith(DELTA_FILE_PREFIX) for file in files):
+        concatenated_raw_data = concatenated_raw_data.drop_duplicates(subset="orgnr", keep="last").reset_index(drop=True)
     if max_rows == -1:
         return concatenated_raw_data
     elif max_rows >= 0:
@@ -1087,6 +1103,16 @@ def Read_data(folder, max_rows, earliest_year):
         print("Max rows error")
         return concatenated_raw_data.head(0)
 
+def Swedish_numbers(values):
+    # Same conversion as Swedish_numbers in the scraper, for the CSV files whose cells are still text
+    cells = pd.Series(values, dtype=object)
+    numbers = pd.to_numeric(cells, errors="coerce").astype(np.float64)
+    text = numbers.isna() & cells.notna()
+    if text.any():
+        numbers[text] = pd.to_numeric(cells[text].astype(str).str.replace(SWEDISH_NUMBER_NOISE, "", regex=True).str.replace(",", ".", regex=False),
+                                      errors="coerce")
+    return numbers.to_numpy()
+
 def Data_cleaning_1(df, earliest_year, sorted_columns_translation_table, activity_types_translation_table):
     # The purpose of this first cleaning is to clean the data to make it suitable for manual analysis.
     # The process doesn't alter the content of the raw data.
@@ -1119,14 +1145,16 @@ def Data_cleaning_1(df, earliest_year, sorted_columns_translation_table, activit
         print("Dropping useless years:", years_to_drop)
         df = df.loc[:, ~df.columns.str.endswith(tuple(years_to_drop))]
 
-        # Iterate over all columns and replace values only if they are strings and the column ends with a specific year
-        # Some columns containing percentage values are converted to integer
-        for col in df.columns:
-            if any(year in col for year in map(str, range(2011, 2023))):
-                print("Removing %, commas, spaces and converting to integers:", col)
-                # Remove the percentage symbol, replace comma with dot, and spaces with an empty string;
-                # finally, convert all values to integers. Note: percentage values are converted to integers taking into account the two decimal places present in the original data.
-                df[col] = df[col].apply(lambda x: pd.to_numeric(str(x).replace(' ', '').rstrip('%').replace(',', '.'), errors='coerce'))
+        # Convert the values of the columns which end with a specific year to numbers.
+        # The percentage symbol and the spaces are removed and the decimal comma becomes a dot; the percentage values keep their two decimal places.
+        # The columns that are numeric already (Parquet/Arrow files, or CSV files written by the recent versions of the scraper) don't need it.
+        # The others are converted one at a time, so that the memory needed doesn't grow with the width of the dataset.
+        year_columns = [col for col in df.columns if any(year in col for year in map(str, range(2011, 2023)))]
+        text_columns = [col for col in year_columns if not pd.api.types.is_numeric_dtype(df[col])]
+        if text_columns:
+            print(f"Removing %, commas, spaces and converting to numbers: {len(text_columns)} columns")
+            for col in text_columns:
+                df[col] = Swedish_numbers(df[col].to_numpy())
         return df
 
 def Data_cleaning_2(df, unrelevant_features, lat_bins = 10, long_bins = 2):
@@ -0,0 +1,331 @@
+# This script measures how much time the scraper spends parsing the pages it downloads.
+# The pages are the ones recorded in the response cache by previous runs of the scraper, so the network is never involved;
+# when the cache has none, synthetic pages with the same structure are used instead.
+# With --site, it measures the whole scraper instead: a local stand-in of the site serves recorded (or synthetic) pages,
+# with the chosen latency and error rate, and the complete pipeline crawls it.
+
+import importlib.util
+import sys
+import os
+import json
+import html
+import math
+import random
+import socket
+import asyncio
+import tempfile
+import shutil
+import contextlib
+import collections
+import multiprocessing
+import http.server
+import time
+import statistics
+import argparse
+import pandas as pd
+try:
+    import resource # Not available on Windows: the CPU time is then the one of the main process only, and the peak RSS isn't reported
+except ImportError:
+    resource = None
+
+# CONSTANTS
+
+SCRAPER_FILENAME = "Swedish companies scraper.py"
+MAX_PAGES = 500 # Maximum number of recorded pages used for each benchmark
+REPEAT = 5 # Each parser reads every page this number of times; the best time is kept
+SITE_COMPANIES = 2000 # Companies listed by the stand-in site (a single search, so at most the RESULTS_CAP of the scraper)
+SITE_LATENCY = 50 # Milliseconds added to each response of the stand-in site, on average
+SITE_ERROR_RATE = 0.0 # Share of the detail pages answered with HTTP 503 by the stand-in site
+SITE_CONCURRENCY = 32
+SITE_PAGE_VARIANTS = 50 # Distinct detail pages served by the stand-in site, in turn; also the synthetic pages timed without --site
+SITE_SECTOR = "BENCHMARK" # Sector of the search crawled on the stand-in site
+PERCENTILES = (50, 99)
+
+
+
+
+def Load_scraper(filename):
+    # The scraper file name contains spaces, so it can't be imported with a plain import statement.
+    # It's registered as a module all the same, so that the workers of its parse stage can find its functions.
+    spec = importlib.util.spec_from_file_location("scraper", filename)
+    scraper = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = scraper
+    spec.loader.exec_module(scraper)
+    return scraper
+
+def Recorded_pages(cache, suffix, max_pages):
+    # Return the most recent body of the cached URLs ending with suffix (for example "/bokslut")
+    urls = [row[0] for row in cache.connection.execute("SELECT DISTINCT url FROM responses WHERE url LIKE ? LIMIT ?",
+                                                        (f"%{suffix}", max_pages))]
+    return [cache.get(url) for url in urls]
+
+def Detail_pages(scraper, cache_folder, synthetic, max_pages, synthetic_pages):
+    # The /verksamhet and /bokslut pages of the benchmarks, and where they come from: the response cache when it has both kinds,
+    # synthetic pages otherwise. A missing cache isn't created.
+    activity_pages = closure_pages = []
+    if not synthetic and os.path.isfile(os.path.join(cache_folder, "index.sqlite")):
+        cache = scraper.ResponseCache(cache_folder)
+        activity_pages = Recorded_pages(cache, "/verksamhet", max_pages)
+        closure_pages = Recorded_pages(cache, "/bokslut", max_pages)
+        cache.close()
+    if activity_pages and closure_pages:
+        return activity_pages, closure_pages, "recorded"
+    return ([Synthetic_activity_page(scraper, i) for i in range(synthetic_pages)],
+            [Synthetic_closure_page(scraper, i) for i in range(synthetic_pages)], "synthetic")
+
+def Time_parser(parser, pages, repeat):
+    # Time needed by parser for each page, in seconds (best of repeat)
+    timings = []
+    for page in pages:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parser(page)
+            best = min(best, time.perf_counter() - start)
+        timings.append(best)
+    return timings
+
+def Normalised_value(value):
+    # The value as the cleaning script will see it, so that parsers returning text or numbers can be compared
+    number = pd.to_numeric(str(value).replace(' ', '').rstrip('%').replace(',', '.'), errors='coerce')
+    return str(value).strip() if pd.isna(number) else number
+
+def Normalised(record):
+    return {key: Normalised_value(value) for key, value in record.items()}
+
+def Benchmark(title, parsers, pages, repeat):
+    print(f"{title}: {len(pages)} pages")
+    reference_name = list(parsers)[0]
+    results = {}
+    for name, parser in parsers.items():
+        timings = Time_parser(parser, pages, repeat)
+        results[name] = timings
+        print(f"\t{name:<12}mean {statistics.mean(timings) * 1000:8.3f} ms/company\tmedian {statistics.median(timings) * 1000:8.3f} ms/company"
+              f"\t{len(pages) / sum(timings):10.1f} companies/s")
+    for name in list(parsers)[1:]:
+        ratio = sum(results[name]) / sum(results[reference_name])
+        if ratio >= 1:
+            print(f"\t{reference_name} is {ratio:.1f} times faster than {name}")
+        else:
+            print(f"\t{reference_name} is {1 / ratio:.1f} times slower than {name}")
+        disagreements = sum(1 for page in pages if Normalised(parsers[reference_name](page)) != Normalised(parsers[name](page)))
+        print(f"\t{disagreements} pages with different values between {reference_name} and {name}")
+
+def Swedish_number(value, decimals=0):
+    # A number written like on the site: spaces between the thousands, decimal comma
+    return f"{value:,.{decimals}f}".replace(",", " ").replace(".", ",")
+
+def Synthetic_company(i):
+    orgnr = f"55{i:08d}"
+    return {"orgnr": orgnr, "jurnamn": f"Bolag {i} &amp; Söner AB" if i % 10 == 0 else f"Bolag {i} AB", "abv_hgrupp": "Bygg",
+            "abv_ugrupp": "Byggnadsverksamhet", "ba_postort": "Uppsala", "linkTo": f"{orgnr}/bolag-{i}"}
+
+def Synthetic_search_page(total, page, per_page):
+    # A result page with the same embedded JSON as the real ones
+    first = (page - 1) * per_page
+    companies = [Synthetic_company(i) for i in range(first, min(total, first + per_page))]
+    pagination = {"current_page": page, "per_page": per_page, "total": total}
+    return (f'<html><head><meta charset="utf-8"></head><body><search :search-result-default="{html.escape(json.dumps(companies, ensure_ascii=False))}" '
+            f':search-result-pagination="{html.escape(json.dumps(pagination))}"></search></body></html>').encode()
+
+def Synthetic_activity_page(scraper, i):
+    fields = "".join(f"<dt>{field}</dt><dd>{value}</dd>" for field, value in
+                     zip(scraper.ACTIVITY_DEFAULTS, ["Aktivt", f"{1990 + i % 30}-01-01", "Privat, ej börsnoterat", "Uppsala"]))
+    return f'<html><head><meta charset="utf-8"></head><body><dl>{fields}</dl>{"<p>Verksamhet</p>" * 200}</body></html>'.encode()
+
+def Synthetic_closure_page(scraper, i):
+    # The four tables of a /bokslut page, with every (row, year) cell the dataset knows.
+    # The rows which aren't key figures are shared among the first three tables; the balance sheet also has its two section rows, without values.
+    generator = random.Random(i)
+    years = sorted({year for _, year in scraper.Closure_cell_slots}, reverse=True)
+    labels = sorted({label for label, _ in scraper.Closure_cell_slots} - set(scraper.KPIs))
+    header = "".join(f"<th>{year}-12</th>" for year in years)
+    tables = []
+    for number, title in enumerate(scraper.CLOSURE_TABLES):
+        if title == "Nyckeltal":
+            rows = [(f"Nyckeltal {k}", [Swedish_number(generator.uniform(-100, 100), 2) + "%" for _ in years]) for k in range(len(scraper.KPIs))]
+        else:
+            rows = [(label, [Swedish_number(generator.randint(-5000, 900000)) for _ in years]) for label in labels[number::3]]
+            if number == 1:
+                rows = [(scraper.CLOSURE_SECTION_ROWS[0], [""] * len(years))] + rows + [(scraper.CLOSURE_SECTION_ROWS[1], [""] * len(years))]
+        body = "".join(f"<tr><td>{html.escape(label)}</td>" + "".join(f"<td>{value}</td>" for value in values) + "</tr>" for label, values in rows)
+        tables.append(f"<table><tr><th>{html.escape(title)}</th>{header}</tr>{body}</table>")
+    return f'<html><head><meta charset="utf-8"></head><body>{"<div>Meny</div>" * 100}{"".join(tables)}</body></html>'.encode()
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # The stand-in site: result pages generated on the fly, detail pages taken in turn from the recorded (or synthetic) ones.
+    # The settings are class attributes, set by Serve.
+    protocol_version = "HTTP/1.1"
+    companies = 0
+    results_per_page = 20
+    activity_pages = []
+    closure_pages = []
+    latency = 0.0
+    error_rate = 0.0
+
+    def do_GET(self):
+        time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        path, _, query = self.path.partition("?")
+        if path.endswith(("/verksamhet", "/bokslut")):
+            if random.random() < self.error_rate:
+                self.answer(503, b"")
+                return
+            company = int(path.strip("/").split("/")[0][2:])
+            pages = self.activity_pages if path.endswith("/verksamhet") else self.closure_pages
+            self.answer(200, pages[company % len(pages)])
+        elif "/what/" in path:
+            page = int(query.split("page=")[1]) if "page=" in query else 1
+            self.answer(200, Synthetic_search_page(self.companies, page, self.results_per_page))
+        else:
+            self.answer(404, b"")
+
+    def answer(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def Serve(port, companies, results_per_page, activity_pages, closure_pages, latency, error_rate):
+    # Body of the process of the stand-in site, so that serving the pages doesn't take CPU time from the scraper being measured
+    StandInHandler.companies = companies
+    StandInHandler.results_per_page = results_per_page
+    StandInHandler.activity_pages = activity_pages
+    StandInHandler.closure_pages = closure_pages
+    StandInHandler.latency = latency
+    StandInHandler.error_rate = error_rate
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+def Free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def Wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def Sampled_metrics(scraper, samples):
+    # The metrics of the scraper, which also keep every duration they observe: the histograms alone give only rough percentiles
+    class SampledMetrics(scraper.CrawlMetrics):
+        def observe(self, name, value, **labels):
+            samples[name, tuple(sorted(labels.items()))].append(value)
+            super().observe(name, value, **labels)
+    return SampledMetrics
+
+def Percentile(values, percentile):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+def Peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def Benchmark_site(scraper, activity_pages, closure_pages, source, companies, latency, error_rate, concurrency, parse_workers,
+                   activity_parser, output_format, warm):
+    # Crawl the stand-in site with the complete scraper and report its throughput, the latency of each stage, its CPU time and its memory
+    port = Free_port()
+    site = multiprocessing.Process(target=Serve, args=(port, companies, scraper.RESULTS_PER_PAGE, activity_pages, closure_pages,
+                                                                   latency / 1000, error_rate), daemon=True)
+    site.start()
+    output_folder = tempfile.mkdtemp(prefix="scraper-benchmark-")
+    try:
+        Wait_for_port(port)
+        scraper.BASE_URL = f"http://127.0.0.1:{port}/"
+        scraper.RAW_DATA_FOLDER = output_folder + os.sep
+        scraper.LOGFILE = os.path.join(output_folder, "Log.jsonl")
+        if warm:
+            # The rate controller starts at full speed: the benchmark measures the pipeline, not the ramp-up
+            scraper.INITIAL_RATE = scraper.MAX_RATE
+            scraper.INITIAL_CONCURRENCY = concurrency
+        samples = collections.defaultdict(list)
+        scraper.CrawlMetrics = Sampled_metrics(scraper, samples)
+        url = f"{scraper.BASE_URL}{scraper.SEARCH_PATH}/{scraper.SECTOR_FACET}/{SITE_SECTOR}"
+        print(f"Stand-in site: {companies} companies, {source} pages, latency {latency} ms, error rate {error_rate:.1%}, concurrency {concurrency}")
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(scraper.Crawl([url], concurrency, journal_path=":memory:", cache_folder=None, activity_parser=activity_parser,
+                                      output_format=output_format, state_path=None, metrics_textfile="", metrics_json="",
+                                      parse_workers=parse_workers))
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        # Each attempt of a company is counted, so the retried ones are taken out
+        written = scraper.Metrics.total("companies_total") - scraper.Metrics.values.get(("retries_total", (("stage", "company"),)), 0)
+        print(f"\t{written:.0f} companies in {elapsed:.1f} s: {written / elapsed:.1f} companies/s, {scraper.Error_count} errors")
+        for (name, labels), values in sorted(samples.items()):
+            stage = name.replace("_seconds", "") + "".join(f" {value}" for _, value in labels)
+            print(f"\t{stage:<32}" + "".join(f"p{percentile} {Percentile(values, percentile) * 1000:9.3f} ms\t" for percentile in PERCENTILES)
+                  + f"{len(values)} samples")
+        if resource is None:
+            print(f"\tCPU: {cpu:.1f} s in the main process ({cpu / elapsed:.0%} of a core)")
+        else:
+            # The workers of the parse stage have ended with the crawl, so their usage is in RUSAGE_CHILDREN;
+            # the stand-in site is still running, so its own isn't
+            workers = resource.getrusage(resource.RUSAGE_CHILDREN)
+            workers_cpu = workers.ru_utime + workers.ru_stime
+            print(f"\tCPU: {cpu:.1f} s in the main process, {workers_cpu:.1f} s in the parse workers ({(cpu + workers_cpu) / elapsed:.0%} of a core)")
+            print(f"\tPeak RSS: {Peak_rss_mb(resource.getrusage(resource.RUSAGE_SELF)):.0f} MB in the main process, "
+                  f"{Peak_rss_mb(workers):.0f} MB in the largest parse worker")
+    finally:
+        site.terminate()
+        site.join()
+        shutil.rmtree(output_folder, ignore_errors=True)
+
+
+
+
+# MAIN
+
+if __name__ == "__main__":
+    Parser = argparse.ArgumentParser(description="Benchmark the parsers of the scraper on recorded pages")
+    Parser.add_argument("--scraper", default=SCRAPER_FILENAME, help="path of the scraper script")
+    Parser.add_argument("--cache", help="folder of the response cache (default: the one of the scraper)")
+    Parser.add_argument("--pages", type=int, default=MAX_PAGES, help="maximum number of pages for each benchmark")
+    Parser.add_argument("--repeat", type=int, default=REPEAT, help="number of times each page is parsed")
+    Parser.add_argument("--site", action="store_true", help="crawl a local stand-in of the site with the whole scraper, instead of timing the parsers")
+    Parser.add_argument("--synthetic", action="store_true", help="use synthetic detail pages even if the response cache has recorded ones")
+    Parser.add_argument("--companies", type=int, default=SITE_COMPANIES, help="with --site, number of companies listed")
+    Parser.add_argument("--latency", type=float, default=SITE_LATENCY, help="with --site, average latency of the responses in milliseconds")
+    Parser.add_argument("--error-rate", type=float, default=SITE_ERROR_RATE, help="with --site, share of the detail pages answered with HTTP 503")
+    Parser.add_argument("--concurrency", type=int, default=SITE_CONCURRENCY, help="with --site, maximum number of requests in flight")
+    Parser.add_argument("--parse-workers", type=int, help="with --site, processes parsing the pages (default: the one of the scraper)")
+    Parser.add_argument("--activity-parser", default="lxml", help="with --site, parser of the /verksamhet pages")
+    Parser.add_argument("--format", default="csv", help="with --site, format of the raw data files")
+    Parser.add_argument("--warm", action="store_true", help="with --site, start the rate controller at full speed instead of ramping up")
+    Arguments = Parser.parse_args()
+
+    Scraper = Load_scraper(Arguments.scraper)
+    if Arguments.site:
+        if Arguments.companies > Scraper.RESULTS_CAP:
+            Parser.error(f"the stand-in site lists a single search, so at most {Scraper.RESULTS_CAP} companies")
+        Activity_pages, Closure_pages, Source = Detail_pages(Scraper, Arguments.cache or Scraper.RESPONSE_CACHE_FOLDER, Arguments.synthetic,
+                                                             SITE_PAGE_VARIANTS, SITE_PAGE_VARIANTS)
+        Benchmark_site(Scraper, Activity_pages, Closure_pages, Source, Arguments.companies, Arguments.latency, Arguments.error_rate,
+                       Arguments.concurrency, Scraper.PARSE_WORKERS if Arguments.parse_workers is None else Arguments.parse_workers,
+                       Arguments.activity_parser, Arguments.format, Arguments.warm)
+        sys.exit()
+    Activity_pages, Closure_pages, Source = Detail_pages(Scraper, Arguments.cache or Scraper.RESPONSE_CACHE_FOLDER, Arguments.synthetic,
+                                                         Arguments.pages, min(Arguments.pages, SITE_PAGE_VARIANTS))
+    if Source == "synthetic" and not Arguments.synthetic:
+        print("No recorded detail pages in the response cache: timing synthetic pages (run the scraper first to time real ones).")
+    Benchmark("Closure tables (/bokslut)",
+              {"lxml": Scraper.Parse_closure_tables, "read_html": Scraper.Parse_closure_tables_read_html},
+              Closure_pages, Arguments.repeat)
+    Activity_parsers = {"lxml": Scraper.Parse_activity_page_lxml}
+    if Scraper.HTMLParser is not None:
+        Activity_parsers["selectolax"] = Scraper.Parse_activity_page_selectolax
+    Activity_parsers["bs4"] = Scraper.Parse_activity_page_bs4
+    Benchmark("Activity data (/verksamhet)", Activity_parsers, Activity_pages, Arguments.repeat)
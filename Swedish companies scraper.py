@@ -1,19 +1,64 @@
 # Valerio "Weed" Malerba, Uppsala, 2023-2024
 
-import requests
+import httpx
 from bs4 import BeautifulSoup
 import datetime
 import time
 import pandas as pd
+import numpy as np
 import json
 import math
 import urllib.parse
-import random
+import re
+import html
+import collections
+import logging
+import logging.handlers
+import queue
+import atexit
+import contextlib
+import bisect
 import subprocess
+import asyncio
+import concurrent.futures
+import argparse
+import io
+import sqlite3
+import hashlib
+import gzip
+import os
+import random
+import heapq
+import itertools
+import csv
+import lxml.html
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser # Optional: alternative parser for the /verksamhet pages
+except ImportError:
+    HTMLParser = None
+try:
+    import pyarrow as pa # Optional: needed to write the Parquet and Arrow IPC output
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+try:
+    import redis # Optional: needed to share the task queue between several machines
+except ImportError:
+    redis = None
+try:
+    import brotli # Optional: lets the server send brotli-compressed pages
+except ImportError:
+    brotli = None
+try:
+    import h2 # Optional: needed by httpx for the HTTP/2 transport
+except ImportError:
+    h2 = None
 
 # CONSTANTS
 
-LOGFILE = "Log.txt"
+LOGFILE = "Log.jsonl" # One JSON object per line, written by a background thread
+LOG_MAX_BYTES = 50 * 1024 * 1024 # The log file is rotated when it reaches this size
+LOG_BACKUP_COUNT = 10 # Number of rotated log files kept (Log.jsonl.1, Log.jsonl.2...)
 UNMAPPABLE_CHARACTER_MSG = "**** UNMAPPABLE CHARACTER DETECTED ****"
 BASE_URL = "https://www.allabolag.se/"
 MAX_ATTEMPTS = 10
@@ -23,16 +68,124 @@ STATUS_FIELD = "Status"
 REGISTRATION_DATE_FIELD = "Bolaget registrerat"
 OWNERSHIP_FIELD = "Ägandeförhållande"
 MUNICIPALITY_FIELD = "Kommunsäte"
-NORDIC_CHAR_REPLACEMENTS = {
-    "\\u00e5": "å",
-    "\\u00c5": "Å",
-    "\\u00c4": "Ä",
-    "\\u00e4": "ä",
-    "\\u00f6": "ö",
-    "&amp;": "&",
-    "\"": ""
-}
+# Values used when a field is missing from the /verksamhet page
+ACTIVITY_DEFAULTS = {STATUS_FIELD: "-", REGISTRATION_DATE_FIELD: "0000-01-01", OWNERSHIP_FIELD: "-", MUNICIPALITY_FIELD: "-"}
+ACTIVITY_PARSER = "lxml" # Parser of the /verksamhet pages: "lxml", "selectolax" or "bs4"
+# The text fields are cleaned once, when their page is parsed (see Clean_text): HTML entities such as "&amp;" are decoded,
+# the JSON escapes left in the text (such as "\\u00e5") become their characters and these characters are removed
+TEXT_REMOVED_CHARACTERS = '"'
 RAW_DATA_FOLDER = "D:\\Documents\\Python Scripts\\Scrapers\\Bolagsskrapare\\Raw data\\"
+CONCURRENCY = 32 # Default maximum number of requests in flight at the same time
+# The rate controller adapts the concurrency and the request rate to what the site tolerates (AIMD):
+# the successful requests increase them steadily, while a share of HTTP 429/5xx responses and network errors among the recent requests,
+# empty result pages and latencies much higher than usual divide them. An isolated failure is left to the retries.
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+INITIAL_RATE = 4.0 # Requests per second
+MIN_RATE = 0.2
+MAX_RATE = 100.0
+RATE_INCREASE = 1.0 # Requests per second added each second of successful requests (RATE_INCREASE / rate by each of them)
+RATE_WINDOW = 50 # Recent requests whose failures are counted
+RATE_MIN_REQUESTS = 25 # The failure share isn't judged on fewer requests than this
+RATE_FAILURE_SHARE = 0.2 # Share of failed requests in the window that is a sign of overload
+AIMD_DECREASE = 0.5 # Concurrency and rate are multiplied by this factor when the site shows signs of overload
+DECREASE_INTERVAL = 2.0 # Seconds: failures closer than this are considered as a single overload event
+LATENCY_THRESHOLD = 3.0 # A smoothed latency this many times higher than the best one is a sign of overload
+RATE_LOG_INTERVAL = 60 # Seconds between two logs of the state of the rate controller
+REQUEST_TIMEOUT = 30 # Seconds
+# A company whose detail pages fail is put aside and tried again later, while the rest of its segment goes on
+RETRY_BASE_DELAY = 2.0 # Seconds before the second attempt; the delay doubles at each attempt, with a random jitter
+RETRY_MAX_DELAY = 120.0 # Seconds
+RETRY_BUDGET_MIN = 100 # Retries of companies always allowed in a crawl
+RETRY_BUDGET_RATIO = 0.1 # Beyond the minimum, retries allowed for each company attempted
+# Circuit breaker: when too many of the recent requests to a host fail, every request to it pauses for a while
+CIRCUIT_WINDOW = 50 # Recent requests considered
+CIRCUIT_MIN_REQUESTS = 20 # The failure rate isn't judged on fewer requests than this
+CIRCUIT_FAILURE_RATE = 0.5
+CIRCUIT_COOLDOWN = 30.0 # Seconds of pause; the pause doubles each time the circuit opens again before a success
+CIRCUIT_MAX_COOLDOWN = 600.0 # Seconds
+# Metrics of the crawl, exported every METRICS_INTERVAL seconds as a Prometheus textfile (for the node_exporter textfile collector)
+# and as a JSON snapshot
+METRICS_TEXTFILE = "Scraper metrics.prom"
+METRICS_JSON = "Scraper metrics.json"
+METRICS_INTERVAL = 30 # Seconds
+METRICS_PREFIX = "allabolag_scraper_"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # Seconds
+PROCESSING_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5) # Seconds
+# Name: (type, help, histogram buckets)
+METRICS = {
+    "fetch_seconds": ("histogram", "Duration of the HTTP requests, by endpoint", LATENCY_BUCKETS),
+    "responses_total": ("counter", "HTTP responses, by endpoint and status", None),
+    "downloaded_bytes_total": ("counter", "Bytes received from the network (before decompression), by endpoint", None),
+    "parse_seconds": ("histogram", "Time spent parsing a page, by parser", PROCESSING_BUCKETS),
+    "parse_wait_seconds": ("histogram", "Time a page spent waiting for a parse worker and coming back from it, by parser", PROCESSING_BUCKETS),
+    "merge_seconds": ("histogram", "Time spent merging the records of a company into its row", PROCESSING_BUCKETS),
+    "write_seconds": ("histogram", "Time spent writing the row of a company", PROCESSING_BUCKETS),
+    "retries_total": ("counter", "Failed attempts that are retried, by stage", None),
+    "companies_total": ("counter", "Companies fetched, by outcome", None),
+    "circuit_breaks_total": ("counter", "Times the requests to a host were paused because too many of them failed, by host", None),
+    "retry_budget_remaining": ("gauge", "Retries of companies still allowed by the retry budget", None),
+    "duplicates_total": ("counter", "Companies skipped because a segment, the same or another one, has already taken them", None),
+    "companies_per_minute": ("gauge", "Companies fetched per minute since the previous export", None),
+    "errors": ("gauge", "Errors counted by the crawl", None),
+    "request_rate": ("gauge", "Requests per second allowed by the rate controller", None),
+    "request_concurrency": ("gauge", "Requests in flight allowed by the rate controller", None),
+}
+CRAWL_JOURNAL = "Crawl journal.sqlite"
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+LEASED = "leased"
+# With --queue, the crawl is split into tasks that any number of worker processes, on any number of machines, lease from a shared queue
+TASK_QUEUE = "Crawl queue.sqlite" # Default queue: a SQLite file for the workers of one machine; a redis:// URL shares it between machines
+REDIS_PREFIX = "allabolag:"
+SEARCH_TASK = "search" # Probe the number of results of a shard and publish its listing pages
+PAGE_TASK = "page" # Read a listing page and publish its companies
+COMPANY_TASK = "company" # Fetch the detail pages of a company; the result is its complete row
+TASK_KINDS = (COMPANY_TASK, PAGE_TASK, SEARCH_TASK) # Leased in this order, so that the companies already found are finished first
+VISIBILITY_TIMEOUT = 600 # Seconds: a leased task not completed in this time is handed to another worker
+QUEUE_LEASE_SIZE = 64 # Tasks held by a worker at the same time
+QUEUE_POLL_INTERVAL = 5 # Seconds between two looks at the queue when there's nothing to do
+RESPONSE_CACHE_FOLDER = "Response cache"
+# The validators (ETag, Last-Modified, content hash) of the detail pages are kept from one crawl to the next, so that
+# a delta crawl (--delta) can request them conditionally and rebuild only the companies whose pages have changed
+FETCH_STATE = "Fetch state.sqlite"
+DELTA_JOURNAL = "Delta journal.sqlite"
+UNCHANGED = "unchanged"
+DATA_FILE_PREFIX = "Company_data "
+DELTA_FILE_PREFIX = "Company_delta " # Files with only the changed rows, upserted on the full data by the cleaning stage
+# Fields of the search results that are kept for each company
+LISTING_FIELDS = ("orgnr", "jurnamn", "abv_hgrupp", "abv_ugrupp", "ba_postort", "linkTo")
+LISTING_TEXT_FIELDS = ("jurnamn", "abv_hgrupp", "abv_ugrupp", "ba_postort") # Fields of the listing cleaned by Clean_text
+SEARCH_PATH = "what/ab"
+RESULTS_PER_PAGE = 20
+RESULTS_CAP = 8000 # The site doesn't show more results than this for a single search, whatever the number of pages
+# Facets of the search, in the order in which they appear in the URLs
+SECTOR_FACET = "xv"
+COUNTY_FACET = "xl"
+COMPANY_TYPE_FACET = "xb"
+EMPLOYEES_FACET = "xe"
+REVENUE_FACET = "xr"
+FACET_ORDER = (SECTOR_FACET, COUNTY_FACET, COMPANY_TYPE_FACET, EMPLOYEES_FACET, REVENUE_FACET)
+# Facets used to split a search with too many results, the first ones being tried first
+SPLIT_ORDER = (SECTOR_FACET, EMPLOYEES_FACET, REVENUE_FACET, COUNTY_FACET)
+REVENUE_RANGE = (None, 50000000) # Thousands of SEK; a range without lower bound includes the negative revenues
+PARALLEL_SEGMENTS = 4 # Shards crawled at the same time
+LISTING_PREFETCH_WORKERS = 8 # Result pages of a shard requested at the same time
+LISTING_BUFFER_PAGES = 16 # Result pages fetched in advance, waiting for their companies to be scheduled
+PARSE_WORKERS = None # Processes of the parse stage (None: one per CPU core; 0: parse in the event loop)
+PARSE_BACKLOG_PAGES = 256 # Detail pages being fetched or waiting for a parser; beyond it, no new detail page is requested
+MAX_COMPANIES_IN_FLIGHT = 500 # Companies of a shard being fetched at the same time; beyond it, the pager waits
+SEEN_BLOOM_ERROR_RATE = 0.01 # False positive rate of the optional Bloom filter of the companies already met (--seen-bloom)
+OUTPUT_FORMAT = "csv" # Format of the raw data files: "csv", "parquet" or "arrow"
+OUTPUT_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+SEGMENT_BUFFER_ROWS = 5000 # Rows of a segment kept in memory before being written to its raw data file
+# Titles of the four tables of a /bokslut page, in the order in which they are merged
+CLOSURE_TABLES = ["Resultaträkning (tkr)", "Balansräkningar (tkr)", "Löner & utdelning (tkr)", "Nyckeltal"]
+# Characters around the digits of the Swedish-formatted numbers ("1 234", "-12,5%"): spaces (also non-breaking) as thousands separators and percent signs
+SWEDISH_NUMBER_NOISE = r"[\s\xa0%]"
+# Rows of the balance sheet which only introduce a section and carry no value
+CLOSURE_SECTION_ROWS = ["Tillgångar", "Skulder, eget kapital och avsättningar"]
 
 
 
@@ -40,11 +193,32 @@ RAW_DATA_FOLDER = "D:\\Documents\\Python Scripts\\Scrapers\\Bolagsskrapare\\Raw
 # INIT
 
 List = []
+Text_translation = str.maketrans("", "", TEXT_REMOVED_CHARACTERS)
+Unicode_escape = re.compile(r"\\u([0-9a-fA-F]{4})")
 # First, open the page and look for company-related data.
 # Each page should contain identifiers for 20 different companies.
 Error_count = 0
-Delay = 0.0
 Count = 0
+# Shared by all the fetches of the event loop, they are created when the crawl starts
+Rate = None
+Metrics = None
+Seen = None
+Retry_budget = None
+Breakers = {} # Circuit breaker of each host
+Parse_pool = None
+Parse_backlog = None
+Log_listener = None
+Activity_parser_name = ACTIVITY_PARSER
+Session = None
+Journal = None
+Cache = None
+Replay = False
+Delta = False
+Fetch_state = None
+Validators = {} # Validators of the pages fetched for the companies in progress, saved in the fetch state once their row is safe
+Replay_date = None
+Activity_parser = None
+Output_format = OUTPUT_FORMAT
 
 Company_dataset_columns = [
     "orgnr",
@@ -415,6 +589,15 @@ Company_dataset_columns = [
     "Vinstmarginal_2022"
 ]
 
+Company_dataset_column_set = set(Company_dataset_columns)
+# The descriptive columns are text, all the yearly figures are numbers
+Company_dataset_text_columns = set(LISTING_FIELDS) | set(ACTIVITY_DEFAULTS)
+# Schema of the row of a company: the slot of each column in the row buffer, and the slot of each (table row label, year)
+# cell of the /bokslut tables, so that a row is filled cell by cell without building any column name
+Company_row_slots = {column: slot for slot, column in enumerate(Company_dataset_columns)}
+Closure_cell_slots = {tuple(column.rsplit("_", 1)): slot for column, slot in Company_row_slots.items()
+                      if "_" in column and column.rsplit("_", 1)[1].isdigit()}
+
 KPIs = [
         "Antal_anställda",
         "Nettoomsättning per anställd (tkr)",
@@ -429,297 +612,1901 @@ KPIs = [
         "Kassalikviditet"
     ]
 
-URLs = [
-        "https://www.allabolag.se/what/ab/xv/OFFENTLIG%20F%C3%96RVALTNING%20&%20SAMH%C3%84LLE/xv/BRANSCH-,%20ARBETSGIVAR-%20&%20YRKESORG./xv/RESEBYR%C3%85%20&%20TURISM/xv/AVLOPP,%20AVFALL,%20EL%20&%20VATTEN/xv/LIVSMEDELSFRAMST%C3%84LLNING/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/UTHYRNING%20&%20LEASING/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/MOTORFORDONSHANDEL/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/H%C3%85R%20&%20SK%C3%96NHETSV%C3%85RD/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/BEMANNING%20&%20ARBETSF%C3%96RMEDLING/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/MEDIA/xb/AB/xe/1",
-        "https://www.allabolag.se/what/ab/xv/MEDIA/xb/AB/xe/2/xe/3/xe/4/xe/5/xe/6/xe/7/xe/8/xe/9",
-        "https://www.allabolag.se/what/ab/xv/JORDBRUK,%20SKOGSBRUK,%20JAKT%20&%20FISKE/xb/AB/xe/1/xe/2",
-        "https://www.allabolag.se/what/ab/xv/JORDBRUK,%20SKOGSBRUK,%20JAKT%20&%20FISKE/xb/AB/xe/9/xe/8/xe/7/xe/6/xe/5/xe/4/xe/3",
-        "https://www.allabolag.se/what/ab/xv/REPARATION%20&%20INSTALLATION/xb/AB/xe/1",
-        "https://www.allabolag.se/what/ab/xv/REPARATION%20&%20INSTALLATION/xb/AB/xe/2/xe/3/xe/4/xe/8/xe/9/xe/7/xe/6",
-        "https://www.allabolag.se/what/ab/xv/REKLAM,%20PR%20&%20MARKNADSUNDERS%C3%96KNING/xb/AB/xe/1",
-        "https://www.allabolag.se/what/ab/xv/REKLAM,%20PR%20&%20MARKNADSUNDERS%C3%96KNING/xb/AB/xe/9/xe/8/xe/7/xe/6/xe/5/xe/4/xe/3/xe/2",
-        "https://www.allabolag.se/what/ab/xv/KULTUR,%20N%C3%96JE%20&%20FRITID/xb/AB/xe/9/xe/8/xe/7/xe/6/xe/5/xe/4/xe/3/xe/2",
-        "https://www.allabolag.se/what/ab/xv/KULTUR,%20N%C3%96JE%20&%20FRITID/xb/AB/xe/1",
-        "https://www.allabolag.se/what/ab/xv/UTBILDNING,%20FORSKNING%20&%20UTVECKLING/xb/AB/xe/1/xe/3/xe/4",
-        "https://www.allabolag.se/what/ab/xv/UTBILDNING,%20FORSKNING%20&%20UTVECKLING/xb/AB/xe/2/xe/5/xe/6/xe/7/xe/8/xe/9",
-        "https://www.allabolag.se/what/ab/xv/TRANSPORT%20&%20MAGASINERING/xb/AB/xe/1/xe/3/xe/4/xe/5/xe/6/xe/7/xe/8/xe/9",
-        "https://www.allabolag.se/what/ab/xv/TRANSPORT%20&%20MAGASINERING/xb/AB/xe/2",
-        "https://www.allabolag.se/what/ab/xv/TEKNISK%20KONSULTVERKSAMHET/xb/AB/xe/1",
-        "https://www.allabolag.se/what/ab/xv/TEKNISK%20KONSULTVERKSAMHET/xl/1/xl/14/xl/12/xl/5/xl/13/xl/3/xl/6/xb/AB/xe/2",
-        "https://www.allabolag.se/what/ab/xv/TEKNISK%20KONSULTVERKSAMHET/xl/6/xl/20/xl/17/xl/4/xl/24/xl/18/xl/21/xl/19/xl/25/xl/8/xl/22/xl/7/xl/23/xl/10/xl/9/xb/AB/xe/2",
-        "https://www.allabolag.se/what/ab/xv/TEKNISK%20KONSULTVERKSAMHET/xl/6/xl/20/xl/17/xl/4/xl/24/xl/18/xl/21/xl/19/xl/25/xl/8/xl/22/xl/7/xl/23/xl/10/xl/9/xl/1/xl/3/xl/13/xl/5/xl/12/xl/14/xb/AB/xe/3/xe/4/xe/5/xe/6/xe/7/xe/8/xe/9",
-        "https://www.allabolag.se/what/ab/xv/HOTELL%20&%20RESTAURANG/xl/1/xl/23/xl/10/xl/7/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/HOTELL%20&%20RESTAURANG/xl/9/xl/22/xl/8/xl/25/xl/21/xl/18/xl/24/xl/4/xl/17/xl/20/xl/6/xl/13/xl/5/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/HOTELL%20&%20RESTAURANG/xl/12/xl/3/xl/19/xl/14/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/H%C3%84LSA%20&%20SJUKV%C3%85RD/xl/1/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/H%C3%84LSA%20&%20SJUKV%C3%85RD/xl/14/xl/12/xl/5/xb/AB",
-        "https://www.allabolag.se/what/ab/xfv/H%C3%84LSA%20&%20SJUKV%C3%85RD/xl/13/xl/3/xl/6/xl/20/xl/17/xl/4/xl/24/xl/18/xl/21/xl/19/xl/25/xl/8/xl/22/xl/7/xl/23/xl/10/xl/9/xb/AB",
-        "https://www.allabolag.se/what/ab/xv/TILLVERKNING%20&%20INDUSTRI/xb/AB/xr/-1200",
-        "https://www.allabolag.se/what/ab/xv/TILLVERKNING%20&%20INDUSTRI/xb/AB/xr/1200-50000",
-        "https://www.allabolag.se/what/ab/xv/TILLVERKNING%20&%20INDUSTRI/xb/AB/xr/50001-5000000",
-        "https://www.allabolag.se/what/ab/xv/BANK,%20FINANS%20&%20F%C3%96RS%C3%84KRING/xb/AB/xr/1-5000",
-        "https://www.allabolag.se/what/ab/xv/BANK,%20FINANS%20&%20F%C3%96RS%C3%84KRING/xb/AB/xr/5001-50000000",
-        "https://www.allabolag.se/what/ab/xv/DETALJHANDEL/xb/AB/xr/1-500",
-        "https://www.allabolag.se/what/ab/xv/DETALJHANDEL/xb/AB/xr/501-3500",
-        "https://www.allabolag.se/what/ab/xv/DETALJHANDEL/xb/AB/xr/3501-30000",
-        "https://www.allabolag.se/what/ab/xv/DETALJHANDEL/xb/AB/xr/30001-10000000",
-        "https://www.allabolag.se/what/ab/xv/DATA,%20IT%20&%20TELEKOMMUNIKATION/xb/AB/xr/1-500",
-        "https://www.allabolag.se/what/ab/xv/DATA,%20IT%20&%20TELEKOMMUNIKATION/xb/AB/xr/501-1500",
-        "https://www.allabolag.se/what/ab/xv/DATA,%20IT%20&%20TELEKOMMUNIKATION/xb/AB/xr/1501-10000",
-        "https://www.allabolag.se/what/ab/xv/DATA,%20IT%20&%20TELEKOMMUNIKATION/xb/AB/xr/10001-50000000",
-        "https://www.allabolag.se/what/ab/xv/PARTIHANDEL/xb/AB/xr/1-500",
-        "https://www.allabolag.se/what/ab/xv/PARTIHANDEL/xb/AB/xr/501-5000",
-        "https://www.allabolag.se/what/ab/xv/PARTIHANDEL/xb/AB/xr/5001-50000",
-        "https://www.allabolag.se/what/ab/xv/PARTIHANDEL/xb/AB/xr/50001-5000000",
-        "https://www.allabolag.se/what/ab/xv/FASTIGHETSVERKSAMHET/xb/AB/xr/1-220",
-        "https://www.allabolag.se/what/ab/xv/FASTIGHETSVERKSAMHET/xb/AB/xr/221-500",
-        "https://www.allabolag.se/what/ab/xv/FASTIGHETSVERKSAMHET/xb/AB/xr/501-900",
-        "https://www.allabolag.se/what/ab/xv/FASTIGHETSVERKSAMHET/xb/AB/xr/901-1600",
-        "https://www.allabolag.se/what/ab/xv/FASTIGHETSVERKSAMHET/xb/AB/xr/1601-3000",
-        "https://www.allabolag.se/what/ab/xv/FASTIGHETSVERKSAMHET/xb/AB/xr/3001-8000",
-        "https://www.allabolag.se/what/ab/xv/FASTIGHETSVERKSAMHET/xb/AB/xr/8001-500000",
-        "https://www.allabolag.se/what/ab/xv/JURIDIK,%20EKONOMI%20&%20KONSULTTJ%C3%84NSTER/xb/AB/xr/1-50",
-        "https://www.allabolag.se/what/ab/xv/JURIDIK,%20EKONOMI%20&%20KONSULTTJ%C3%84NSTER/xb/AB/xr/51-200",
-        "https://www.allabolag.se/what/ab/xv/JURIDIK,%20EKONOMI%20&%20KONSULTTJ%C3%84NSTER/xb/AB/xr/201-400",
-        "https://www.allabolag.se/what/ab/xv/JURIDIK,%20EKONOMI%20&%20KONSULTTJ%C3%84NSTER/xb/AB/xr/401-800",
-        "https://www.allabolag.se/what/ab/xv/JURIDIK,%20EKONOMI%20&%20KONSULTTJ%C3%84NSTER/xb/AB/xr/801-1200",
-        "https://www.allabolag.se/what/ab/xv/JURIDIK,%20EKONOMI%20&%20KONSULTTJ%C3%84NSTER/xb/AB/xr/1201-2000",
-        "https://www.allabolag.se/what/ab/xv/JURIDIK,%20EKONOMI%20&%20KONSULTTJ%C3%84NSTER/xb/AB/xr/2001-9000",
-        "https://www.allabolag.se/what/ab/xv/JURIDIK,%20EKONOMI%20&%20KONSULTTJ%C3%84NSTER/xb/AB/xr/9001-500000",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/1-150",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/151-500",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/501-900",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/901-1400",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/1401-2000",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/2001-3000",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/3001-5000",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/5001-10000",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/10001-50000",
-        "https://www.allabolag.se/what/ab/xv/BYGG-,%20DESIGN-%20&%20INREDNINGSVERKSAMHET/xb/AB/xr/50001-50000000"
+# The whole search is partitioned automatically into shards small enough for the site to show all their results
+# (see Partition). These are the values of the facets the partitioner can split on.
+SECTORS = [
+        "OFFENTLIG FÖRVALTNING & SAMHÄLLE",
+        "BRANSCH-, ARBETSGIVAR- & YRKESORG.",
+        "RESEBYRÅ & TURISM",
+        "AVLOPP, AVFALL, EL & VATTEN",
+        "LIVSMEDELSFRAMSTÄLLNING",
+        "UTHYRNING & LEASING",
+        "MOTORFORDONSHANDEL",
+        "HÅR & SKÖNHETSVÅRD",
+        "BEMANNING & ARBETSFÖRMEDLING",
+        "MEDIA",
+        "JORDBRUK, SKOGSBRUK, JAKT & FISKE",
+        "REPARATION & INSTALLATION",
+        "REKLAM, PR & MARKNADSUNDERSÖKNING",
+        "KULTUR, NÖJE & FRITID",
+        "UTBILDNING, FORSKNING & UTVECKLING",
+        "TRANSPORT & MAGASINERING",
+        "TEKNISK KONSULTVERKSAMHET",
+        "HOTELL & RESTAURANG",
+        "HÄLSA & SJUKVÅRD",
+        "TILLVERKNING & INDUSTRI",
+        "BANK, FINANS & FÖRSÄKRING",
+        "DETALJHANDEL",
+        "DATA, IT & TELEKOMMUNIKATION",
+        "PARTIHANDEL",
+        "FASTIGHETSVERKSAMHET",
+        "JURIDIK, EKONOMI & KONSULTTJÄNSTER",
+        "BYGG-, DESIGN- & INREDNINGSVERKSAMHET"
       ]
+COMPANY_TYPES = ["AB"]
+EMPLOYEE_BUCKETS = ["1", "2", "3", "4", "5", "6", "7", "8", "9"]
+COUNTIES = ["1", "3", "4", "5", "6", "7", "8", "9", "10", "12", "13", "14", "17", "18", "19", "20", "21", "22", "23", "24", "25"]
+FACET_VALUES = {SECTOR_FACET: SECTORS, COUNTY_FACET: COUNTIES, COMPANY_TYPE_FACET: COMPANY_TYPES, EMPLOYEES_FACET: EMPLOYEE_BUCKETS}
+ROOT_FACETS = {SECTOR_FACET: SECTORS, COMPANY_TYPE_FACET: COMPANY_TYPES}
 
 
 
-def Log(text, print_to_console):
-    timestamp = datetime.datetime.now().strftime(f"{DATE_FORMAT} {TIME_FORMAT}")
-    with open(LOGFILE, 'a') as f:
-        try:
-            f.write(f"{timestamp}:\t{text}\n")
-        except:
-            f.write(f"{timestamp}:\t{UNMAPPABLE_CHARACTER_MSG}\n")
+class JsonLinesFormatter(logging.Formatter):
+    # Each log entry is a JSON object on its own line, with the structured fields given to Log (url, attempt...)
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"), "level": record.levelname,
+                 "message": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def Start_logging(path):
+    # Log only puts the entries in a queue; a background thread writes them to the rotating UTF-8 file,
+    # so that logging never waits for the disk. The thread is stopped, and the queue flushed, when the script exits.
+    global Log_listener
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    handler.setFormatter(JsonLinesFormatter())
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger("allabolag_scraper")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    Log_listener = logging.handlers.QueueListener(log_queue, handler)
+    Log_listener.start()
+    atexit.register(Log_listener.stop)
+
+def Log(text, print_to_console, level=logging.INFO, **fields):
+    if Log_listener is None:
+        Start_logging(LOGFILE)
+    logging.getLogger("allabolag_scraper").log(level, text, extra={"fields": fields})
     if print_to_console:
-        print(f"{timestamp}:\t{text}\n")
-
-def Wait_with_random_delay(base_delay):
-    random_delay = random.uniform(base_delay, 2 * base_delay)
-    if random.randint(0, 200) == 0:
-        random_delay += random.randint(20, 40)
-        print(f"Time for a {int(random_delay)} seconds break!")
-        remaining_time = random_delay
-        while remaining_time >= 5:
-            time.sleep(5)
-            remaining_time -= 5
-            print(f"{int(remaining_time)} seconds left.")
-    else:
-        time.sleep(random_delay)
-    return random_delay
+        timestamp = datetime.datetime.now().strftime(f"{DATE_FORMAT} {TIME_FORMAT}")
+        try:
+            print(f"{timestamp}:\t{text}\n")
+        except UnicodeEncodeError:
+            # The Windows console can't show every character
+            print(f"{timestamp}:\t{UNMAPPABLE_CHARACTER_MSG}\n")
 
 def Clean_text(text):
-    for old, new in NORDIC_CHAR_REPLACEMENTS.items():
-        text = text.replace(old, new)
-    return text
+    # A single pass of each kind: JSON escapes, HTML entities, removed characters
+    if "\\u" in text:
+        # A character beyond U+FFFF is escaped as a surrogate pair: the round trip through UTF-16 joins its two halves,
+        # and a lone half becomes U+FFFD, since the UTF-16 files can't hold it
+        text = Unicode_escape.sub(lambda match: chr(int(match.group(1), 16)), text).encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+    return html.unescape(text).translate(Text_translation)
 
-def Retrieve_company_page_list(page_content, page):
-    global Error_count
-    result = pd.DataFrame()
+def Clean_record(record):
+    return {field: Clean_text(value) if isinstance(value, str) else value for field, value in record.items()}
+
+class CrawlJournal:
+    # Embedded SQLite journal of the crawl. Every segment, listing page and company is recorded as pending, done or failed.
+    # Each finished company is committed together with its row as soon as it completes, so that a restarted run
+    # can rebuild the segment from the journal and fetch only what is still missing.
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS segments (url TEXT PRIMARY KEY, status TEXT NOT NULL, filename TEXT);
+            CREATE TABLE IF NOT EXISTS pages (url TEXT NOT NULL, page INTEGER NOT NULL, status TEXT NOT NULL, rows TEXT,
+                                              PRIMARY KEY (url, page));
+            CREATE TABLE IF NOT EXISTS companies (url TEXT NOT NULL, orgnr TEXT NOT NULL, status TEXT NOT NULL, row TEXT,
+                                                  PRIMARY KEY (url, orgnr));
+            CREATE TABLE IF NOT EXISTS searches (url TEXT PRIMARY KEY, total INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS seen (orgnr TEXT PRIMARY KEY, url TEXT NOT NULL);
+        """)
+        self.connection.commit()
+
+    def segment_done(self, url):
+        found = self.connection.execute("SELECT status FROM segments WHERE url = ?", (url,)).fetchone()
+        return found is not None and found[0] == DONE
+
+    def segment_failures(self, url):
+        # Listing pages and companies of the segment that are still failed
+        return sum(self.connection.execute(f"SELECT COUNT(*) FROM {table} WHERE url = ? AND status = ?", (url, FAILED)).fetchone()[0]
+                   for table in ("pages", "companies"))
+
+    def segment_filename(self, url):
+        # The name given to the output file of the segment when it was first started, None for a new segment
+        found = self.connection.execute("SELECT filename FROM segments WHERE url = ?", (url,)).fetchone()
+        return None if found is None else found[0]
+
+    def mark_segment(self, url, status, filename=None):
+        self.connection.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?)", (url, status, filename))
+        self.connection.commit()
+
+    def search_total(self, url):
+        # The number of results of a search already probed, so that a resumed crawl finds the same partition without probing again
+        found = self.connection.execute("SELECT total FROM searches WHERE url = ?", (url,)).fetchone()
+        return None if found is None else found[0]
+
+    def mark_search_total(self, url, total):
+        self.connection.execute("INSERT OR REPLACE INTO searches VALUES (?, ?)", (url, total))
+        self.connection.commit()
+
+    def seen_companies(self):
+        return self.connection.execute("SELECT orgnr, url FROM seen")
+
+    def seen_owner(self, orgnr):
+        # The segment that took the company first, None if no segment has met it yet
+        found = self.connection.execute("SELECT url FROM seen WHERE orgnr = ?", (orgnr,)).fetchone()
+        return None if found is None else found[0]
+
+    def mark_seen(self, orgnr, url):
+        self.connection.execute("INSERT OR IGNORE INTO seen VALUES (?, ?)", (orgnr, url))
+        self.connection.commit()
+
+    def page_rows(self, url, page):
+        # The listing rows of a page that has already been read, None if the page still has to be fetched
+        found = self.connection.execute("SELECT rows FROM pages WHERE url = ? AND page = ? AND status = ?", (url, page, DONE)).fetchone()
+        return None if found is None else json.loads(found[0])
+
+    def mark_page(self, url, page, status, rows=None):
+        self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", (url, page, status, rows))
+        self.connection.commit()
+
+    def add_companies(self, url, orgnrs):
+        self.connection.executemany("INSERT OR IGNORE INTO companies (url, orgnr, status) VALUES (?, ?, ?)",
+                                    [(url, orgnr, PENDING) for orgnr in orgnrs])
+        self.connection.commit()
+
+    def company_row(self, url, orgnr):
+        # The finished row of a company, None if the company still has to be fetched
+        found = self.connection.execute("SELECT row FROM companies WHERE url = ? AND orgnr = ? AND status = ?", (url, orgnr, DONE)).fetchone()
+        return None if found is None else Company_row_from_json(json.loads(found[0]))
+
+    def company_unchanged(self, url, orgnr):
+        # True if a previous run of a delta crawl found the company unchanged
+        found = self.connection.execute("SELECT status FROM companies WHERE url = ? AND orgnr = ?", (url, orgnr)).fetchone()
+        return found is not None and found[0] == UNCHANGED
+
+    def mark_company(self, url, orgnr, status, row=None):
+        self.connection.execute("INSERT OR REPLACE INTO companies VALUES (?, ?, ?, ?)", (url, orgnr, status, row))
+        self.connection.commit()
+
+    def segments_done(self):
+        return self.connection.execute("SELECT COUNT(*) FROM segments WHERE status = ?", (DONE,)).fetchone()[0]
+
+    def reset(self):
+        # Forget everything about the previous runs, so that the next crawl starts from scratch
+        self.connection.executescript("DELETE FROM segments; DELETE FROM pages; DELETE FROM companies; DELETE FROM searches; DELETE FROM seen;")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+class BloomFilter:
+    # Set of strings in a fixed-size bit array: it can answer "maybe present" for an absent item (at about error_rate
+    # once it holds capacity items), but never "absent" for a present one. The positions come from double hashing of a BLAKE2 digest.
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+class SeenCompanies:
+    # Organisation numbers already met by the crawl, with the segment that took each of them first.
+    # The facets overlap, so the same company can be listed by several segments: only its first segment fetches and writes it.
+    # The set lives in memory and is backed by the crawl journal, so it survives a restart. With a Bloom filter,
+    # the memory stays small whatever the size of the crawl: only the "maybe seen" answers are checked in the journal.
+
+    def __init__(self, journal, bloom_capacity=None):
+        self.journal = journal
+        self.bloom = BloomFilter(bloom_capacity, SEEN_BLOOM_ERROR_RATE) if bloom_capacity else None
+        self.owners = {} if self.bloom is None else None
+        for orgnr, url in journal.seen_companies():
+            self.remember(orgnr, url)
+
+    def remember(self, orgnr, url):
+        if self.bloom is None:
+            self.owners[orgnr] = url
+        else:
+            self.bloom.add(orgnr)
+
+    def owner(self, orgnr):
+        if self.bloom is None:
+            return self.owners.get(orgnr)
+        return self.journal.seen_owner(orgnr) if orgnr in self.bloom else None
+
+    def claim(self, orgnr, url):
+        # True if the segment url has to fetch the company: nobody met it before, or url itself did (in an interrupted run)
+        owner = self.owner(orgnr)
+        if owner is None:
+            self.journal.mark_seen(orgnr, url)
+            self.remember(orgnr, url)
+            return True
+        return owner == url
+
+class FetchState:
+    # Persistent SQLite record of the last fetch of every detail page: when it happened, its ETag and Last-Modified headers,
+    # and the SHA-256 of its content. Unlike the crawl journal, it outlives the crawls.
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, fetched_at TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+                                "content_hash TEXT NOT NULL)")
+        self.connection.commit()
+
+    def get(self, url):
+        # (ETag, Last-Modified, content hash) of the last fetch of url, None if it has never been fetched
+        return self.connection.execute("SELECT etag, last_modified, content_hash FROM pages WHERE url = ?", (url,)).fetchone()
+
+    def put(self, rows):
+        # rows: (url, fetch time, ETag, Last-Modified, content hash)
+        self.connection.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+QueueTask = collections.namedtuple("QueueTask", ["id", "kind", "url", "payload", "attempts"])
+
+class SQLiteTaskQueue:
+    # Durable task queue in a SQLite file, shared by the worker processes of one machine.
+    # A leased task becomes visible again when its lease expires before it's completed, so the work of a dead worker isn't lost.
+    # The result of each completed task is kept in the queue until it's collected into the raw data files.
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, kind TEXT NOT NULL, priority INTEGER NOT NULL, url TEXT NOT NULL,
+                                              payload TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+                                              lease_until REAL NOT NULL DEFAULT 0, result TEXT);
+            CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, priority);
+        """)
+
+    def publish(self, tasks):
+        # Publishing a task that already exists does nothing, so a shard or a page can be published again safely
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.executemany("INSERT OR IGNORE INTO tasks (id, kind, priority, url, payload, status) VALUES (?, ?, ?, ?, ?, ?)",
+                                        [(task.id, task.kind, TASK_KINDS.index(task.kind), task.url, json.dumps(task.payload), PENDING) for task in tasks])
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def lease(self, count, visibility_timeout):
+        # The selection and the update happen in one write transaction, so that two workers never lease the same task
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.connection.execute("SELECT id, kind, url, payload, attempts FROM tasks WHERE status IN (?, ?) AND lease_until < ? "
+                                           "ORDER BY priority LIMIT ?", (PENDING, LEASED, now, count)).fetchall()
+            self.connection.executemany("UPDATE tasks SET status = ?, attempts = attempts + 1, lease_until = ? WHERE id = ?",
+                                        [(LEASED, now + visibility_timeout, row[0]) for row in rows])
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+        return [QueueTask(task_id, kind, url, json.loads(payload), attempts + 1) for task_id, kind, url, payload, attempts in rows]
+
+    def complete(self, task, result=None):
+        self.connection.execute("UPDATE tasks SET status = ?, result = ? WHERE id = ?", (DONE, None if result is None else json.dumps(result), task.id))
+
+    def fail(self, task, retry_at=None):
+        # The task is handed out again from the time retry_at on, or never again if retry_at is None
+        status = FAILED if retry_at is None else PENDING
+        self.connection.execute("UPDATE tasks SET status = ?, lease_until = ? WHERE id = ? AND status = ?", (status, retry_at or 0, task.id, LEASED))
+
+    def counts(self):
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(self.connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return counts
+
+    def segments(self, kind):
+        # The URLs of the shards with completed tasks of this kind
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT url FROM tasks WHERE kind = ? AND status = ?", (kind, DONE))]
+
+    def results(self, kind, url):
+        for row in self.connection.execute("SELECT result FROM tasks WHERE kind = ? AND url = ? AND status = ? AND result IS NOT NULL", (kind, url, DONE)):
+            yield json.loads(row[0])
+
+    def close(self):
+        self.connection.close()
+
+class RedisTaskQueue:
+    # The same queue on a Redis-compatible server, so that workers on several machines (and IP addresses) can share one crawl.
+    # The pending ids are kept in one list per kind of task and the leased ones in a sorted set, scored by the end of their lease.
+    # Leasing and failing are Lua scripts, so that they're atomic whatever the number of workers.
+    # A failed task waiting for its next attempt stays in the sorted set, scored by the time at which it's due.
+
+    PUBLISH_SCRIPT = """
+        for i = 1, #ARGV, 3 do
+            if redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 2]) == 1 then
+                redis.call('RPUSH', KEYS[2] .. ARGV[i + 1], ARGV[i])
+            end
+        end
+    """
+    LEASE_SCRIPT = """
+        local now, deadline, count = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now)) do
+            redis.call('ZREM', KEYS[1], id)
+            redis.call('RPUSH', ARGV[4] .. string.match(id, '^%S+'), id)
+        end
+        local leased = {}
+        for i = 3, #KEYS do
+            while #leased < count do
+                local id = redis.call('LPOP', KEYS[i])
+                if not id then break end
+                redis.call('ZADD', KEYS[1], deadline, id)
+                redis.call('HINCRBY', KEYS[2], id, 1)
+                leased[#leased + 1] = id
+            end
+        end
+        return leased
+    """
+    FAIL_SCRIPT = """
+        if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+            if ARGV[2] == '' then
+                redis.call('SADD', KEYS[2], ARGV[1])
+            else
+                redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+            end
+        end
+    """
+
+    def __init__(self, location, prefix=REDIS_PREFIX):
+        self.redis = redis.Redis.from_url(location, decode_responses=True)
+        self.prefix = prefix
+        self.publish_script = self.redis.register_script(self.PUBLISH_SCRIPT)
+        self.lease_script = self.redis.register_script(self.LEASE_SCRIPT)
+        self.fail_script = self.redis.register_script(self.FAIL_SCRIPT)
+
+    def key(self, name):
+        return self.prefix + name
+
+    def publish(self, tasks):
+        arguments = []
+        for task in tasks:
+            arguments += [task.id, task.kind, json.dumps([task.url, task.payload])]
+        if arguments:
+            self.publish_script(keys=[self.key("tasks"), self.key("pending:")], args=arguments)
+
+    def lease(self, count, visibility_timeout):
+        now = time.time()
+        task_ids = self.lease_script(keys=[self.key("leases"), self.key("attempts")] + [self.key("pending:" + kind) for kind in TASK_KINDS],
+                                     args=[now, now + visibility_timeout, count, self.key("pending:")])
+        if not task_ids:
+            return []
+        tasks = self.redis.hmget(self.key("tasks"), task_ids)
+        attempts = self.redis.hmget(self.key("attempts"), task_ids)
+        return [QueueTask(task_id, task_id.split(" ", 1)[0], *json.loads(task), int(attempt))
+                for task_id, task, attempt in zip(task_ids, tasks, attempts)]
+
+    def complete(self, task, result=None):
+        pipeline = self.redis.pipeline()
+        pipeline.zrem(self.key("leases"), task.id)
+        pipeline.sadd(self.key("done"), task.id)
+        if result is not None:
+            pipeline.hset(self.key(f"results:{task.kind}:{task.url}"), task.id, json.dumps(result))
+            pipeline.sadd(self.key(f"segments:{task.kind}"), task.url)
+        pipeline.execute()
+
+    def fail(self, task, retry_at=None):
+        self.fail_script(keys=[self.key("leases"), self.key("failed")], args=[task.id, "" if retry_at is None else retry_at])
+
+    def counts(self):
+        return {PENDING: sum(self.redis.llen(self.key("pending:" + kind)) for kind in TASK_KINDS), LEASED: self.redis.zcard(self.key("leases")),
+                DONE: self.redis.scard(self.key("done")), FAILED: self.redis.scard(self.key("failed"))}
+
+    def segments(self, kind):
+        return sorted(self.redis.smembers(self.key(f"segments:{kind}")))
+
+    def results(self, kind, url):
+        for _, result in self.redis.hscan_iter(self.key(f"results:{kind}:{url}")):
+            yield json.loads(result)
+
+    def close(self):
+        self.redis.close()
+
+def Open_task_queue(location):
+    if location.startswith(("redis://", "rediss://", "unix://")):
+        if redis is None:
+            raise ImportError("The redis package is needed to use a Redis task queue")
+        return RedisTaskQueue(location)
+    return SQLiteTaskQueue(location)
+
+class ResponseCache:
+    # Compressed, content-addressed store of every response fetched by the crawl.
+    # The bodies are saved once under the SHA-256 of their content (objects/ab/abcd....gz),
+    # while a small SQLite index maps each (URL, fetch date) to the hash of the body received that day.
+    # This allows to run the parsers again on the whole population without touching the network (see --replay).
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(os.path.join(folder, "objects"), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(folder, "index.sqlite"))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT NOT NULL, fetch_date TEXT NOT NULL, content_hash TEXT NOT NULL, "
+                                "PRIMARY KEY (url, fetch_date))")
+        self.connection.commit()
+
+    def object_path(self, content_hash):
+        return os.path.join(self.folder, "objects", content_hash[:2], content_hash + ".gz")
+
+    def put(self, url, content):
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self.object_path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first, so that a crash never leaves a truncated object behind
+            with open(path + ".tmp", "wb") as f:
+                f.write(gzip.compress(content))
+            os.replace(path + ".tmp", path)
+        self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                                (url, datetime.date.today().strftime(DATE_FORMAT), content_hash))
+        self.connection.commit()
+
+    def get(self, url, fetch_date=None):
+        # The body fetched on the given date (the most recent one if no date is given), None if the URL isn't cached
+        if fetch_date is None:
+            found = self.connection.execute("SELECT content_hash FROM responses WHERE url = ? ORDER BY fetch_date DESC LIMIT 1", (url,)).fetchone()
+        else:
+            found = self.connection.execute("SELECT content_hash FROM responses WHERE url = ? AND fetch_date = ?", (url, fetch_date)).fetchone()
+        if found is None:
+            return None
+        with open(self.object_path(found[0]), "rb") as f:
+            return gzip.decompress(f.read())
+
+    def close(self):
+        self.connection.close()
+
+def Csv_value(value):
+    # Format a value like DataFrame.to_csv does (the text fields have already been cleaned by the parsers)
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return str(value)
+
+class SegmentWriter:
+    # Write the companies of a segment to its CSV file one row at a time, as soon as each of them is complete,
+    # in the same format that DataFrame.to_csv used (juridical name first, semicolon separated, UTF-16).
+    # The rows go to a ".partial" file, which gets its final name only when the whole segment has been written,
+    # so that an interrupted segment is never read as a complete one by the cleaning script.
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.file = open(path + ".partial", "w", encoding="utf-16", newline="")
+        self.writer = csv.writer(self.file, delimiter=";", lineterminator=os.linesep)
+        self.writer.writerow(["jurnamn"] + columns)
+
+    def write_rows(self, names, rows):
+        # rows: the values of the columns, in their order (see New_company_row)
+        self.writer.writerows([Csv_value(name)] + [Csv_value(value) for value in row] for name, row in zip(names, rows))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.file.close()
+        if exception_type is None:
+            os.replace(self.path + ".partial", self.path)
+
+def Swedish_numbers(values):
+    # Vectorised conversion of the cells of a table to float64: "1 234", "-12,5%" and the like become numbers,
+    # anything else (empty cells, "-", None) becomes NaN. The values that are numbers already are kept as they are.
+    # The rules are the same used by Data_cleaning_1 on the legacy CSV files.
+    cells = pd.Series(values, dtype=object)
+    numbers = pd.to_numeric(cells, errors="coerce").astype(np.float64)
+    text = numbers.isna() & cells.notna()
+    if text.any():
+        numbers[text] = pd.to_numeric(cells[text].astype(str).str.replace(SWEDISH_NUMBER_NOISE, "", regex=True).str.replace(",", ".", regex=False),
+                                      errors="coerce")
+    return numbers.to_numpy()
+
+class ArrowSegmentWriter:
+    # Same as SegmentWriter, but the rows are written to a typed, zstd-compressed Parquet or Arrow IPC file.
+    # The schema comes from Company_dataset_columns: the numbers are stored as float64, missing ones as nulls.
+    # Each buffer of rows of the segment (see SegmentRows) becomes a record batch.
+
+    def __init__(self, path, columns, file_format):
+        self.path = path
+        self.columns = columns
+        self.schema = pa.schema([("jurnamn", pa.string())] +
+                                [(column, pa.string() if column in Company_dataset_text_columns else pa.float64()) for column in columns])
+        if file_format == "parquet":
+            self.writer = pq.ParquetWriter(path + ".partial", self.schema, compression="zstd")
+        else:
+            self.writer = pa.ipc.new_file(path + ".partial", self.schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+        self.text_columns = [column in Company_dataset_text_columns for column in columns]
+
+    def write_rows(self, names, rows):
+        # rows: a two-dimensional array, one row per company and one column per column of the file
+        batch = [list(names)]
+        for is_text, values in zip(self.text_columns, rows.T):
+            if is_text:
+                batch.append([None if value is None else str(value) for value in values])
+            else:
+                batch.append(pa.array(Swedish_numbers(values), type=pa.float64(), from_pandas=True))
+        self.writer.write_batch(pa.record_batch(batch, schema=self.schema))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.writer.close()
+        if exception_type is None:
+            os.replace(self.path + ".partial", self.path)
+
+def Create_segment_writer(path, columns):
+    if Output_format == "csv":
+        return SegmentWriter(path, columns)
+    return ArrowSegmentWriter(path, columns, Output_format)
+
+class SegmentRows:
+    # The rows of a segment on their way to its raw data file, in a preallocated columnar buffer indexed by organisation number:
+    # storing a row is a dictionary lookup and a row assignment, and a company has a single slot whatever its name
+    # (names aren't unique, organisation numbers are). The same index tells which companies the segment has already taken,
+    # so a company listed twice by the segment (the result pages can shift while they're read) is fetched and written once.
+    # The buffer goes to the writer every SEGMENT_BUFFER_ROWS rows, so the memory used doesn't grow with the size of the segment.
+
+    def __init__(self, writer, capacity=SEGMENT_BUFFER_ROWS):
+        self.writer = writer
+        self.names = np.empty(capacity, dtype=object)
+        self.rows = np.empty((capacity, len(Company_dataset_columns)), dtype=object)
+        self.slots = {} # Organisation number: slot of its row in the buffer
+        self.size = 0
+        self.taken = set()
+
+    @staticmethod
+    def key(orgnr):
+        # The organisation number as an integer, whether it's written "5561234567" or "556123-4567".
+        # The raw data keeps orgnr as the site writes it; Data_cleaning_2 of the dataset script removes the dash from it
+        # (then named "organization number"), so the listings can hold either form.
+        return int(str(orgnr).replace("-", ""))
+
+    def claim(self, orgnr):
+        # False if the company has already been taken by the segment
+        key = self.key(orgnr)
+        if key in self.taken:
+            return False
+        self.taken.add(key)
+        return True
+
+    def put(self, orgnr, name, row):
+        key = self.key(orgnr)
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.size == len(self.names):
+                self.flush()
+            slot = self.size
+            self.size += 1
+            self.slots[key] = slot
+        self.names[slot] = name
+        self.rows[slot] = row
+
+    def flush(self):
+        if self.size > 0:
+            self.writer.write_rows(self.names[:self.size], self.rows[:self.size])
+            self.slots.clear()
+            self.size = 0
+
+class RateController:
+    # Adaptive throttling of the requests, with additive increase and multiplicative decrease (AIMD) of both
+    # the number of requests in flight and the number of requests started per second.
+    # It works like a semaphore whose size changes over time, plus a pacing of the start times.
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(min(INITIAL_CONCURRENCY, max_concurrency))
+        self.rate = INITIAL_RATE
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.next_start = 0.0
+        self.latency = None # Smoothed latency of the successful requests
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.outcomes = collections.deque(maxlen=RATE_WINDOW) # True for each failed request among the recent ones
+
+    async def acquire(self):
+        # Wait for a free slot, then for the start time given by the rate. Return the start time of the request.
+        if self.in_flight < int(self.concurrency):
+            self.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter # release() hands its slot over
+            except asyncio.CancelledError:
+                if not waiter.cancelled():
+                    # The slot was handed over just before the cancellation: it goes to the next waiter
+                    self.release(None, None)
+                raise
+        try:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + 1 / self.rate
+            if start > now:
+                await asyncio.sleep(start - now)
+        except asyncio.CancelledError:
+            self.release(None, None)
+            raise
+        return time.monotonic()
+
+    def release(self, start, overloaded):
+        # overloaded is None when the request didn't complete (cancelled, or failed on this side): its slot is freed,
+        # but it tells nothing about the site
+        self.in_flight -= 1
+        if overloaded is not None:
+            self.outcomes.append(overloaded)
+        if overloaded:
+            if len(self.outcomes) >= RATE_MIN_REQUESTS and sum(self.outcomes) >= RATE_FAILURE_SHARE * len(self.outcomes):
+                self.decrease()
+        elif overloaded is not None:
+            latency = time.monotonic() - start
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            # The reference latency is allowed to drift up slowly, so that a permanently slower site isn't seen as overloaded forever
+            self.best_latency = self.latency if self.best_latency is None else min(self.best_latency * 1.01, self.latency)
+            if self.latency > LATENCY_THRESHOLD * self.best_latency:
+                self.decrease()
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.rate = min(MAX_RATE, self.rate + RATE_INCREASE / self.rate)
+        while self.waiters and self.in_flight < int(self.concurrency):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_INTERVAL:
+            return
+        self.last_decrease = now
+        self.decreases += 1
+        # The next decision is taken on the requests made at the new pace
+        self.outcomes.clear()
+        self.concurrency = max(MIN_CONCURRENCY, self.concurrency * AIMD_DECREASE)
+        self.rate = max(MIN_RATE, self.rate * AIMD_DECREASE)
+
+    def retry_delay(self, attempt_number):
+        # A failed request waits a number of pacing intervals that grows with the attempts
+        return attempt_number / self.rate
+
+    def snapshot(self):
+        return {"rate": round(self.rate, 2), "concurrency": round(self.concurrency, 2), "in_flight": self.in_flight,
+                "latency": None if self.latency is None else round(self.latency, 3), "decreases": self.decreases}
+
+class CircuitBreaker:
+    # Failure rate of the recent requests to a host. When it spikes, the circuit opens: every request to the host,
+    # whatever its stage, waits for the end of a pause, which doubles each time the circuit opens again before a success.
+    # Unlike the rate controller, which slows the crawl down, this stops it while the site is down.
+
+    def __init__(self, host):
+        self.host = host
+        self.outcomes = collections.deque(maxlen=CIRCUIT_WINDOW)
+        self.cooldown = CIRCUIT_COOLDOWN
+        self.open_until = 0.0
+
+    async def wait(self):
+        delay = self.open_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.open_until - time.monotonic()
+
+    def record(self, failed):
+        now = time.monotonic()
+        if now < self.open_until:
+            # A request started before the circuit opened
+            return
+        self.outcomes.append(failed)
+        if not failed:
+            self.cooldown = CIRCUIT_COOLDOWN
+        elif len(self.outcomes) >= CIRCUIT_MIN_REQUESTS and sum(self.outcomes) >= CIRCUIT_FAILURE_RATE * len(self.outcomes):
+            self.open_until = now + self.cooldown
+            Log(f"{sum(self.outcomes)} of the last {len(self.outcomes)} requests to {self.host} failed: pausing them for {self.cooldown:.0f} s",
+                True, logging.WARNING, host=self.host, pause=self.cooldown)
+            Metrics.inc("circuit_breaks_total", host=self.host)
+            self.cooldown = min(CIRCUIT_MAX_COOLDOWN, self.cooldown * 2)
+            self.outcomes.clear()
+
+class RetryBudget:
+    # Retries of companies (or of queue tasks) allowed in the whole crawl: a minimum, plus a share of those attempted,
+    # so that a site failing for every company doesn't get its requests multiplied by the retries
+
+    def __init__(self, minimum, ratio):
+        self.minimum = minimum
+        self.ratio = ratio
+        self.attempts = 0
+        self.retries = 0
+
+    def attempt(self):
+        self.attempts += 1
+
+    def remaining(self):
+        return max(0, int(self.minimum + self.ratio * self.attempts) - self.retries)
+
+    def withdraw(self):
+        if self.remaining() == 0:
+            return False
+        self.retries += 1
+        return True
+
+class RetryQueue:
+    # Companies of a segment waiting for their next attempt, ordered by the time at which they're due,
+    # with the records of the pages that their failed attempt did retrieve.
+    # Like asyncio.Queue, it counts the unfinished retries, so that the segment can wait for all of them with join().
+
+    def __init__(self):
+        self.heap = []
+        self.order = itertools.count()
+        self.pushed = asyncio.Event()
+        self.unfinished = 0
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, company, attempt_number, records):
+        # attempt_number: the attempt that has just failed
+        heapq.heappush(self.heap, (time.monotonic() + Retry_delay(attempt_number), next(self.order), company, attempt_number + 1, records))
+        self.unfinished += 1
+        self.finished.clear()
+        self.pushed.set()
+
+    async def get(self):
+        # Wait for the first company that is due. Return it with the number of its next attempt and its records.
+        while True:
+            self.pushed.clear()
+            delay = self.heap[0][0] - time.monotonic() if self.heap else None
+            if delay is not None and delay <= 0:
+                _, _, company, attempt_number, records = heapq.heappop(self.heap)
+                return company, attempt_number, records
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.pushed.wait(), delay)
+
+    def task_done(self):
+        self.unfinished -= 1
+        if self.unfinished == 0:
+            self.finished.set()
+
+    async def join(self):
+        await self.finished.wait()
+
+class CrawlMetrics:
+    # In-memory counters, gauges and histograms of the crawl (see METRICS), with their Prometheus and JSON renderings.
+    # They're only updated from the event loop, so they need no locking.
+
+    def __init__(self):
+        self.values = collections.defaultdict(float) # (name, labels): value of the counters and gauges
+        self.histograms = {} # (name, labels): [count of each bucket, the last one being +Inf], sum, count
+        self.last_export = (time.monotonic(), 0)
+
+    def inc(self, name, amount=1, **labels):
+        self.values[name, tuple(sorted(labels.items()))] += amount
+
+    def set(self, name, value, **labels):
+        self.values[name, tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        histogram = self.histograms.setdefault((name, tuple(sorted(labels.items()))), [[0] * (len(buckets) + 1), 0.0, 0])
+        histogram[0][bisect.bisect_left(buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def total(self, name):
+        return sum(value for (metric, _), value in self.values.items() if metric == name)
+
+    def prometheus_text(self):
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            full_name = METRICS_PREFIX + name
+            lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} {kind}"]
+            if kind == "histogram":
+                for (metric, labels), (counts, total, count) in sorted(self.histograms.items()):
+                    if metric == name:
+                        cumulative = 0
+                        for bound, bucket_count in zip(buckets + (math.inf,), counts):
+                            cumulative += bucket_count
+                            lines.append(f"{full_name}_bucket{Prometheus_labels(labels + (('le', '+Inf' if bound == math.inf else bound),))} {cumulative}")
+                        lines.append(f"{full_name}_sum{Prometheus_labels(labels)} {total}")
+                        lines.append(f"{full_name}_count{Prometheus_labels(labels)} {count}")
+            else:
+                lines += [f"{full_name}{Prometheus_labels(labels)} {value}" for (metric, labels), value in sorted(self.values.items()) if metric == name]
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        metrics = {}
+        for (name, labels), value in sorted(self.values.items()):
+            metrics.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+            bounds = [str(bound) for bound in METRICS[name][2]] + ["+Inf"]
+            metrics.setdefault(name, []).append({"labels": dict(labels), "count": count, "sum": total, "buckets": dict(zip(bounds, counts))})
+        return {"time": datetime.datetime.now().isoformat(timespec="seconds"), "metrics": metrics}
+
+def Prometheus_labels(labels):
+    # {key="value",...}, with the backslashes and quotes of the values escaped
+    if not labels:
+        return ""
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+def Write_atomically(path, text):
+    # The file is replaced in one step, so that the collectors never read a half-written file
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+def Export_metrics(textfile, json_path):
+    # Update the gauges taken from the rest of the crawl, then write the metrics files
+    now = time.monotonic()
+    companies = Metrics.total("companies_total")
+    last_time, last_companies = Metrics.last_export
+    if now > last_time:
+        Metrics.set("companies_per_minute", (companies - last_companies) * 60 / (now - last_time))
+    Metrics.last_export = (now, companies)
+    Metrics.set("errors", Error_count)
+    if Retry_budget is not None:
+        Metrics.set("retry_budget_remaining", Retry_budget.remaining())
+    if Rate is not None:
+        Metrics.set("request_rate", Rate.rate)
+        Metrics.set("request_concurrency", Rate.concurrency)
     try:
-        search_results_html = BeautifulSoup(page_content, 'html.parser').find('search')[':search-result-default']
-        search_results_json = json.loads(search_results_html)
-        result = pd.DataFrame(search_results_json)
-    except Exception as e:
-        Log(f"Error retrieving page list at {page_content}: {e}", True)
-    return result
+        if textfile:
+            Write_atomically(textfile, Metrics.prometheus_text())
+        if json_path:
+            Write_atomically(json_path, json.dumps(Metrics.snapshot(), indent=1))
+    except OSError as e:
+        Log(f"Unable to write the metrics: {e}", False)
+
+async def Monitor_metrics(textfile, json_path):
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        Export_metrics(textfile, json_path)
+
+def Endpoint(url):
+    # The kind of page requested, used as label of the metrics
+    if url.endswith("/verksamhet"):
+        return "verksamhet"
+    if url.endswith("/bokslut"):
+        return "bokslut"
+    return "search" if SEARCH_PATH in url else "other"
+
+async def Monitor_rate():
+    # Log the state of the rate controller from time to time
+    while True:
+        await asyncio.sleep(RATE_LOG_INTERVAL)
+        state = Rate.snapshot()
+        Log(f"Rate controller: {state['rate']} requests/s, concurrency {state['concurrency']}, {state['in_flight']} in flight, "
+            f"latency {state['latency']} s, {state['decreases']} decreases", True)
+
+def Create_session(concurrency, http2):
+    # A single client is shared by every request of the crawl: connections are pooled and kept alive,
+    # so the TCP and TLS handshakes are paid once per connection instead of once per page.
+    if http2 and h2 is None:
+        Log("HTTP/2 requested, but the h2 package is not installed. Using HTTP/1.1.", True)
+        http2 = False
+    accepted_encodings = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+    return httpx.AsyncClient(http2=http2,
+                             limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+                             headers={"Accept-Encoding": accepted_encodings},
+                             timeout=REQUEST_TIMEOUT,
+                             follow_redirects=True)
+
+def Circuit_breaker(url):
+    host = urllib.parse.urlsplit(url).netloc
+    if host not in Breakers:
+        Breakers[host] = CircuitBreaker(host)
+    return Breakers[host]
+
+async def Fetch_response(url, headers=None, keep_validators=False):
+    # Every network request of the crawl goes through this coroutine. The rate controller decides when it can start,
+    # whatever the stage it comes from (listing pages or company pages), and learns from its outcome.
+    # While the circuit breaker of the host is open, nothing starts at all.
+    # The validators of the detail pages are kept aside until the company they belong to is safely recorded (see Save_validators).
+    endpoint = Endpoint(url)
+    breaker = Circuit_breaker(url)
+    await breaker.wait()
+    start = await Rate.acquire()
+    overloaded = None
+    try:
+        with Metrics.timer("fetch_seconds", endpoint=endpoint):
+            response = await Session.get(url, headers=headers)
+        overloaded = response.status_code == 429 or response.status_code >= 500
+    except httpx.HTTPError:
+        overloaded = True
+        breaker.record(failed=True)
+        Metrics.inc("responses_total", endpoint=endpoint, status="error")
+        raise
+    finally:
+        # The slot is given back whatever happens, even when the request is cancelled
+        Rate.release(start, overloaded)
+    breaker.record(failed=overloaded)
+    Metrics.inc("responses_total", endpoint=endpoint, status=str(response.status_code))
+    Metrics.inc("downloaded_bytes_total", response.num_bytes_downloaded, endpoint=endpoint)
+    if response.status_code != 304:
+        response.raise_for_status()
+        if Cache is not None:
+            Cache.put(url, response.content)
+        if keep_validators:
+            Validators[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"), hashlib.sha256(response.content).hexdigest())
+    return response
+
+async def Fetch_content(url, keep_validators=False):
+    # The content is returned as (already decompressed) bytes, the parsers take care of the decoding
+    if Replay:
+        content = Cache.get(url, Replay_date)
+        if content is None:
+            raise LookupError(f"{url} is not in the response cache")
+        return content
+    return (await Fetch_response(url, keep_validators=keep_validators)).content
+
+async def Fetch_if_changed(url):
+    # Conditional request of a page fetched by a previous crawl. Return its content, or None when it hasn't changed:
+    # either the server answers 304 Not Modified, or the content has the same hash as last time.
+    previous = Fetch_state.get(url)
+    if previous is None:
+        return await Fetch_content(url, keep_validators=True)
+    etag, last_modified, content_hash = previous
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = await Fetch_response(url, headers, keep_validators=True)
+    if response.status_code == 304:
+        Validators[url] = previous
+        return None
+    return None if Validators[url][2] == content_hash else response.content
+
+def Save_validators(urls):
+    # Called once the row of a company is safe (or known to be unchanged), so that a crawl interrupted before
+    # doesn't leave pages marked as seen whose changes were never written
+    fetched_at = datetime.datetime.now().isoformat(timespec="seconds")
+    rows = [(url, fetched_at) + Validators.pop(url) for url in urls if url in Validators]
+    if rows and Fetch_state is not None:
+        Fetch_state.put(rows)
 
-def Get_closure_data(company, delay):
+def Discard_validators(urls):
+    for url in urls:
+        Validators.pop(url, None)
+
+def Retry_delay(attempt_number):
+    # Exponential backoff with jitter, so that the companies failed together aren't retried together
+    return random.uniform(0.5, 1) * min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt_number - 1))
+
+async def Wait_before_retry(attempt_number, stage):
+    # When replaying from the cache, waiting doesn't make a missing response appear
+    Metrics.inc("retries_total", stage=stage)
+    if not Replay:
+        await asyncio.sleep(Rate.retry_delay(attempt_number))
+
+class ListingRecord:
+    # A company found in the search results. Only the fields used by the dataset are kept, in slots,
+    # so that the listing of even the largest segment takes little memory.
+    __slots__ = LISTING_FIELDS
+
+    def __init__(self, orgnr, jurnamn, abv_hgrupp, abv_ugrupp, ba_postort, linkTo):
+        self.orgnr = str(orgnr)
+        self.jurnamn = str(jurnamn)
+        self.abv_hgrupp = abv_hgrupp
+        self.abv_ugrupp = abv_ugrupp
+        self.ba_postort = ba_postort
+        self.linkTo = str(linkTo)
+
+    @classmethod
+    def from_json(cls, item):
+        return cls(*[item.get(field) for field in LISTING_FIELDS])
+
+    @classmethod
+    def from_listing(cls, item):
+        # A company as the search page lists it: its text fields are cleaned here, once, so that they're stored clean
+        record = dict(item)
+        for field in LISTING_TEXT_FIELDS:
+            if isinstance(record.get(field), str):
+                record[field] = Clean_text(record[field])
+        return cls.from_json(record)
+
+    def to_json(self):
+        return {field: getattr(self, field) for field in LISTING_FIELDS}
+
+    def row(self):
+        # The listing data as it goes in the row of the company (the juridical name is written apart)
+        return {field: getattr(self, field) for field in LISTING_FIELDS if field != "jurnamn"}
+
+def Parse_search_page(content):
+    # The total number of results of a search (None when the page doesn't contain it) and the companies of the page,
+    # both read from the JSON embedded in the search element, in a single parse of the page
+    search = lxml.html.fromstring(content).find(".//search")
+    if search is None:
+        return None, []
+    total = None
+    for name, value in search.attrib.items():
+        if name == ":search-result-default" or not value.startswith("{"):
+            continue
+        pagination = json.loads(value)
+        if "total" in pagination:
+            total = int(pagination["total"])
+    companies = search.get(":search-result-default")
+    return total, [] if companies is None else [ListingRecord.from_listing(item) for item in json.loads(companies)]
+
+def Parse_listing_page(content):
+    # The companies of a search result page: the JSON embedded in the search element is parsed once, straight into records
+    search = lxml.html.fromstring(content).find(".//search")
+    return [ListingRecord.from_listing(item) for item in json.loads(search.get(":search-result-default"))]
+
+async def Number_of_results(url):
+    # The response that gives the number of results is also the first result page: its companies are kept in the journal,
+    # so that the pager doesn't request it again
     global Error_count
-    name = str(company[1]["jurnamn"]).replace("&amp;", "&")
-    closure_url = f"{BASE_URL}{str(company[1]['linkTo']).split('/')[0]}/bokslut"
+    total = Journal.search_total(url)
     attempt_number = 0
-    succeeded = False
-    while not succeeded and attempt_number < MAX_ATTEMPTS:
-        company_merged_data = pd.DataFrame()
+    while total is None and attempt_number < MAX_ATTEMPTS:
         attempt_number += 1
         try:
-            # wait_with_random_delay(delay)
-            company_tables = pd.read_html(closure_url)
-            succeeded = True
-        except:
-            time.sleep(attempt_number * 1.5)
-            print(f"\t\t\tAttempt {attempt_number} to get data about {name} failed. Retrying...")
-    if attempt_number >= MAX_ATTEMPTS and not succeeded:
-        Log(f"Data request error about {name}", True)
-        Error_count += 1
-    else:
+            content = await Fetch_content(url)
+            total, company_page_list = await Parse(Parse_search_page, content, "listing")
+        except Exception as e:
+            Log(f"Error retrieving the number of results in {url}: {e}", False, logging.WARNING, url=url, attempt=attempt_number)
+        if total is None:
+            await Wait_before_retry(attempt_number, "search")
+        else:
+            Journal.mark_search_total(url, total)
+            if company_page_list:
+                Journal.mark_page(url, 1, DONE, json.dumps([company.to_json() for company in company_page_list]))
+    if total is None:
+        Error_count = Error_count + 1
+    return total
+
+def Facet_URL(facets):
+    # The search URL of a dictionary of facets: every facet has a list of values, except the revenue which is a (low, high) range
+    parts = [BASE_URL + SEARCH_PATH]
+    for key in FACET_ORDER:
+        if key == REVENUE_FACET and key in facets:
+            low, high = facets[key]
+            parts.append(f"{key}/{'' if low is None else low}-{high}")
+        else:
+            parts += [f"{key}/{urllib.parse.quote(value, safe=',&')}" for value in facets.get(key, [])]
+    return "/".join(parts)
+
+def Revenue_halves(revenue_range):
+    # Split a revenue range in two, None if it can't be split. The positive ranges are split at their geometric middle,
+    # since the companies are much denser at low revenues.
+    low, high = revenue_range
+    if low is None or low < 1:
+        return ((low, 0), (1, high)) if high > 1 else None
+    if high <= low:
+        return None
+    middle = min(max(int(math.sqrt(low * high)), low), high - 1)
+    return (low, middle), (middle + 1, high)
+
+def Pack_values(shards, key):
+    # Group shards that differ only by a single value of key into shards close to the cap (first fit decreasing),
+    # so that the work units have similar sizes
+    groups = []
+    for facets, total in sorted(shards, key=lambda shard: shard[1], reverse=True):
+        for group in groups:
+            if group[1] + total <= RESULTS_CAP:
+                group[0][key] = group[0][key] + facets[key]
+                group[1] += total
+                break
+        else:
+            groups.append([dict(facets), total])
+    return [(facets, total) for facets, total in groups]
+
+def Merge_revenue_ranges(shards):
+    # Merge the consecutive revenue ranges of a split as long as the cap allows it
+    merged = []
+    for facets, total in shards:
+        if merged and total is not None and merged[-1][1] is not None and merged[-1][1] + total <= RESULTS_CAP \
+                and facets.keys() == merged[-1][0].keys() and all(facets[key] == merged[-1][0][key] for key in facets if key != REVENUE_FACET) \
+                and merged[-1][0][REVENUE_FACET][1] + 1 == facets[REVENUE_FACET][0]:
+            previous = merged.pop()
+            facets = dict(facets, **{REVENUE_FACET: (previous[0][REVENUE_FACET][0], facets[REVENUE_FACET][1])})
+            total += previous[1]
+        merged.append((facets, total))
+    return merged
+
+async def Partition(facets):
+    # Split a search recursively until each part has no more results than the site shows.
+    # Return the list of (facets, number of results) of the parts; a part whose number of results is unknown is kept as it is.
+    url = Facet_URL(facets)
+    total = await Number_of_results(url)
+    if total is None:
+        Log(f"Unable to retrieve the number of results in {url}: it's crawled as it is", True)
+        return [(facets, None)]
+    if total <= RESULTS_CAP:
+        return [(facets, total)] if total > 0 else []
+    for key in SPLIT_ORDER:
+        if key == REVENUE_FACET:
+            halves = Revenue_halves(facets.get(key, REVENUE_RANGE))
+            if halves is not None:
+                parts = await asyncio.gather(*[Partition(dict(facets, **{key: half})) for half in halves])
+                return Merge_revenue_ranges(parts[0] + parts[1])
+        else:
+            values = facets.get(key, FACET_VALUES[key])
+            if len(values) > 1:
+                children = [dict(facets, **{key: [value]}) for value in values]
+                parts = await asyncio.gather(*[Partition(child) for child in children])
+                # The values small enough are packed together again, the others have been split further
+                packable = [len(part) == 1 and part[0][0] is child and part[0][1] is not None for child, part in zip(children, parts)]
+                return Pack_values([part[0] for part, pack in zip(parts, packable) if pack], key) + \
+                    [shard for part, pack in zip(parts, packable) if not pack for shard in part]
+    Log(f"{url} has {total} results, more than the {RESULTS_CAP} shown by the site, and can't be split further", True)
+    return [(facets, total)]
+
+async def Shard_URLs(facets):
+    shards = await Partition(facets)
+    Log(f"The search has been partitioned into {len(shards)} shards, with {sum(total or 0 for _, total in shards)} results", True)
+    return [Facet_URL(shard_facets) for shard_facets, _ in shards]
+
+def Page_URL(url, page):
+    # The pages are numbered from 1, like on the site; the first one is the search URL itself
+    return url if page == 1 else f"{url}?page={page}"
+
+async def Get_page_content(url, page):
+    global Error_count
+    try:
+        page_content = await Fetch_content(Page_URL(url, page))
+    except Exception:
+        # If the first attempt to access fails, make a second attempt after a short wait.
+        await Wait_before_retry(1, "listing")
         try:
-            company_tables[0].index = company_tables[0]["Resultaträkning (tkr)"]
-            company_tables[0].drop("Resultaträkning (tkr)", axis=1, inplace=True)
-            company_tables[1].index = company_tables[1]["Balansräkningar (tkr)"]
-            company_tables[1].drop("Balansräkningar (tkr)", axis=1, inplace=True)
-            company_tables[2].index = company_tables[2]["Löner & utdelning (tkr)"]
-            company_tables[2].drop("Löner & utdelning (tkr)", axis=1, inplace=True)
-            company_tables[3].drop("Nyckeltal", axis=1, inplace=True)
-            company_tables[3].index = KPIs
-            company_tables[1].drop(["Tillgångar", "Skulder, eget kapital och avsättningar"], inplace=True)
-            company_tables[3].columns = company_tables[2].columns
-            company_merged_data = pd.concat([company_tables[0], company_tables[1], company_tables[2], company_tables[3]])
-            company_merged_data = company_merged_data[
-                company_merged_data.columns.drop(list(company_merged_data.filter(regex="Unnamed")))]
-        except:
-            Log(f"Error merging data about {name}", True)
-            Error_count += 1
+            print("First attempt to read page " + str(page) + " failed. Retrying...")
+            page_content = await Fetch_content(Page_URL(url, page))
+            print("Second attempt succeeded!")
+        except Exception as e:
+            page_content = b""
+            Log(f"Error reading page {page}: {e}", True, logging.ERROR, url=url, page=page)
+            Error_count = Error_count + 1
+    return page_content
+
+def Cell_text(cell):
+    # Most cells contain plain text, for which .text is much cheaper than .text_content()
+    return (cell.text or "").strip() if len(cell) == 0 else cell.text_content().strip()
+
+def New_company_row():
+    # Preallocated row buffer of a company, one slot per column of Company_dataset_columns (None for the missing values)
+    return np.full(len(Company_dataset_columns), None, dtype=object)
+
+def Fill_company_row(row, record):
+    # Put the values of a {column: value} record (listing or activity data) in their slots
+    for column, value in record.items():
+        slot = Company_row_slots.get(column)
+        if slot is not None:
+            row[slot] = value
+
+def Company_row_from_json(data):
+    # Rows are stored as lists in the journal and in the task queue
+    return np.array(data, dtype=object)
+
+def Parse_closure_row(content, row):
+    # Read the four financial tables of a /bokslut page with lxml, straight into the slots of the row of the company.
+    # The year comes from the column header ("2022-12" becomes "2022"), empty cells are skipped and,
+    # when two columns fall in the same year, the first one wins, exactly like the previous read_html version.
+    # Return the number of values found.
+    document = lxml.html.fromstring(content)
+    tables = {table.xpath("normalize-space(.//tr[1]/*[1])"): table for table in document.iter("table")}
+    found = 0
+    for title in CLOSURE_TABLES:
+        if title not in tables:
+            raise ValueError(f"Table '{title}' not found")
+        rows = tables[title].xpath(".//tr")
+        years = [Cell_text(cell)[:-3] for cell in rows[0].xpath("./th|./td")[1:]]
+        if title == "Nyckeltal":
+            # The key figures are labelled with the names used in the dataset, by position
+            if len(rows) - 1 != len(KPIs):
+                raise ValueError(f"{len(rows) - 1} key figures found, {len(KPIs)} expected")
+            labels = KPIs
+        else:
+            labels = [Cell_text(row[0]) for row in rows[1:]]
+        for label, table_row in zip(labels, rows[1:]):
+            if label in CLOSURE_SECTION_ROWS:
+                continue
+            for year, cell in zip(years, table_row[1:]):
+                slot = Closure_cell_slots.get((label, year))
+                if slot is not None and row[slot] is None:
+                    value = Cell_text(cell)
+                    if value:
+                        row[slot] = value
+                        found += 1
+    return found
+
+def Parse_closure_cells(content):
+    # The values of a /bokslut page and their slots in the row of the company, for the workers of the parse stage.
+    # The numbers are converted here, once for the whole page: the cells without a number are left out.
+    row = New_company_row()
+    Parse_closure_row(content, row)
+    slots = np.flatnonzero(row != None)
+    values = Swedish_numbers(row[slots])
+    found = ~np.isnan(values)
+    return slots[found], values[found]
+
+def Parse_closure_tables(content):
+    # The same data as a flat {metric_year: value} record, with the names of Company_dataset_columns
+    row = New_company_row()
+    Parse_closure_row(content, row)
+    return {column: value for column, value in zip(Company_dataset_columns, row) if value is not None}
+
+def Parse_closure_tables_read_html(content):
+    # Previous version of Parse_closure_tables, based on pd.read_html.
+    # It isn't used by the crawl anymore, but it's kept as a reference for the benchmark.
+    company_tables = pd.read_html(io.BytesIO(content))
+    company_tables[0].index = company_tables[0]["Resultaträkning (tkr)"]
+    company_tables[0].drop("Resultaträkning (tkr)", axis=1, inplace=True)
+    company_tables[1].index = company_tables[1]["Balansräkningar (tkr)"]
+    company_tables[1].drop("Balansräkningar (tkr)", axis=1, inplace=True)
+    company_tables[2].index = company_tables[2]["Löner & utdelning (tkr)"]
+    company_tables[2].drop("Löner & utdelning (tkr)", axis=1, inplace=True)
+    company_tables[3].drop("Nyckeltal", axis=1, inplace=True)
+    company_tables[3].index = KPIs
+    company_tables[1].drop(["Tillgångar", "Skulder, eget kapital och avsättningar"], inplace=True)
+    company_tables[3].columns = company_tables[2].columns
+    company_merged_data = pd.concat([company_tables[0], company_tables[1], company_tables[2], company_tables[3]])
+    company_merged_data = company_merged_data[
+        company_merged_data.columns.drop(list(company_merged_data.filter(regex="Unnamed")))]
     company_stacked_data = pd.DataFrame(company_merged_data.stack())
     company_stacked_data.index = company_stacked_data.index.map("_".join)
     shortened_index = [index[:-3] for index in company_stacked_data.index]
     company_stacked_data.index = shortened_index
     result_df = company_stacked_data.transpose().loc[:, ~company_stacked_data.transpose().columns.duplicated()].transpose()
-    return result_df
+    return {column: value for column, value in result_df.iloc[:, 0].items() if column in Company_dataset_column_set}
+
+def Timed_parse(parser, content):
+    # The result of the parser and its duration, measured in the worker itself
+    start = time.perf_counter()
+    result = parser(content)
+    return result, time.perf_counter() - start
+
+async def Parse(parser, content, name):
+    # The parse stage: the CPU-bound parsing runs in a pool of processes, so it uses every core and leaves the event loop to the network.
+    # The raw bytes of the page are handed to the worker as they are. A detail page holds a slot of Parse_backlog from its request
+    # to the end of its parsing: when the parsers fall behind, the slots run out and the fetchers stop requesting new pages.
+    # parse_seconds measures the parsing alone; the rest of the round trip to the pool goes to parse_wait_seconds.
+    start = time.perf_counter()
+    if Parse_pool is None:
+        result, seconds = Timed_parse(parser, content)
+    else:
+        result, seconds = await asyncio.get_running_loop().run_in_executor(Parse_pool, Timed_parse, parser, content)
+    Metrics.observe("parse_seconds", seconds, parser=name)
+    Metrics.observe("parse_wait_seconds", max(0.0, time.perf_counter() - start - seconds), parser=name)
+    return result
 
-def Get_activity_data(company, delay):
+def Detail_URLs(company):
+    # The /verksamhet and /bokslut pages of a company
+    company_url = f"{BASE_URL}{company.linkTo.split('/')[0]}"
+    return company_url + "/verksamhet", company_url + "/bokslut"
+
+async def Get_closure_data(company, content=None, cells=None):
+    # The closure cells of the company (see Parse_closure_cells), or None if its /bokslut page couldn't be fetched.
+    # A failed request isn't retried here: the company is (see RetryQueue). A page that has been fetched is final,
+    # even without tables or numbers: it gives no cells, and another attempt wouldn't find more.
+    # content: the /bokslut page when it has already been fetched; cells: those of a previous attempt of the company.
     global Error_count
-    name = str(company[1]["jurnamn"]).replace("&amp;", "&")
-    activity_url = f"{BASE_URL}{str(company[1]['linkTo']).split('/')[0]}/verksamhet"
-    attempt_number = 0
-    succeeded = False
-    activity_details = []
-    while not succeeded and attempt_number < MAX_ATTEMPTS:
-        attempt_number += 1
+    if cells is not None:
+        return cells
+    name = company.jurnamn
+    closure_url = Detail_URLs(company)[1]
+    async with Parse_backlog:
         try:
-            # wait_with_random_delay(delay)
-            soup = BeautifulSoup(requests.get(activity_url).content, 'html.parser')
-            try:
-                status = soup.find('dt', string=STATUS_FIELD).find_next('dd').get_text(strip=True)
-            except:
-                status = "-"
-            try:
-                registration_date = soup.find('dt', string=REGISTRATION_DATE_FIELD).find_next('dd').get_text(strip=True)
-            except:
-                registration_date = "0000-01-01"
-            try:
-                ownership = soup.find('dt', string=OWNERSHIP_FIELD).find_next('dd').get_text(strip=True)
-            except:
-                ownership = "-"
-            try:
-                municipality = soup.find('dt', string=MUNICIPALITY_FIELD).find_next('dd').get_text(strip=True)
-            except:
-                municipality = "-"
-            activity_details = pd.DataFrame({STATUS_FIELD: status, REGISTRATION_DATE_FIELD: registration_date, OWNERSHIP_FIELD: ownership, MUNICIPALITY_FIELD: municipality}, index=[0])
-            try:
-                activity_details = activity_details[[STATUS_FIELD, REGISTRATION_DATE_FIELD, OWNERSHIP_FIELD, MUNICIPALITY_FIELD]]
-            except:
-                activity_details = activity_details[[STATUS_FIELD, REGISTRATION_DATE_FIELD, OWNERSHIP_FIELD]]
-                activity_details = activity_details.copy()
-                activity_details.loc[0, MUNICIPALITY_FIELD] = "-"
-            succeeded = True
+            if content is None:
+                content = await Fetch_content(closure_url, keep_validators=True)
         except Exception as e:
-            time.sleep(2 + attempt_number * 1.5)
-            print(f"\t\t\tAttempt {attempt_number} to get data about {name} failed, due to '{e}'. Retrying...")
-            Log(f"Error retrieving activity data for {name}: {e}", False)
-    return activity_details
+            Log(f"Error retrieving closure data for {name}: {e}", False, logging.WARNING, orgnr=company.orgnr, url=closure_url)
+            return None
+        try:
+            return await Parse(Parse_closure_cells, content, "closure")
+        except Exception as e:
+            Log(f"Error merging data about {name}: {e}", True, logging.ERROR, orgnr=company.orgnr, url=closure_url)
+            Error_count += 1
+    return np.empty(0, dtype=np.intp), np.empty(0)
 
+def Parse_activity_page_bs4(content):
+    # Original version: a full BeautifulSoup tree, then a search for each field.
+    # It's slower than the other parsers, but it's kept to compare their results.
+    soup = BeautifulSoup(content, 'html.parser')
+    record = dict(ACTIVITY_DEFAULTS)
+    for field in record:
+        try:
+            record[field] = soup.find('dt', string=field).find_next('dd').get_text(strip=True)
+        except:
+            pass
+    return Clean_record(record)
 
+def Parse_activity_page_lxml(content):
+    # Single pass over the dt and dd elements of the page: each wanted dt takes the text of the dd that follows it.
+    # The walk stops as soon as all the fields have been found.
+    record = dict(ACTIVITY_DEFAULTS)
+    missing = set(record)
+    pending_fields = []
+    for element in lxml.html.fromstring(content).iter("dt", "dd"):
+        text = "".join(piece.strip() for piece in element.itertext())
+        if element.tag == "dt":
+            if text in missing and text not in pending_fields:
+                pending_fields.append(text)
+        elif pending_fields:
+            for field in pending_fields:
+                record[field] = text
+                missing.discard(field)
+            pending_fields = []
+            if not missing:
+                break
+    return Clean_record(record)
 
+def Parse_activity_page_selectolax(content):
+    # Same single pass as Parse_activity_page_lxml, with the lexbor parser of selectolax
+    record = dict(ACTIVITY_DEFAULTS)
+    missing = set(record)
+    pending_fields = []
+    for node in HTMLParser(content).css("dt, dd"):
+        text = node.text(strip=True)
+        if node.tag == "dt":
+            if text in missing and text not in pending_fields:
+                pending_fields.append(text)
+        elif pending_fields:
+            for field in pending_fields:
+                record[field] = text
+                missing.discard(field)
+            pending_fields = []
+            if not missing:
+                break
+    return Clean_record(record)
 
-# MAIN
+ACTIVITY_PARSERS = {"lxml": Parse_activity_page_lxml, "selectolax": Parse_activity_page_selectolax, "bs4": Parse_activity_page_bs4}
 
-Log("**************** BEGIN ****************", False)
-
-for URL in URLs:
-    Data = pd.DataFrame()
-    Log("Processing " + URL, True)
-    Unquoted_URL = urllib.parse.unquote(URL).split("/")
-    # First, determine how many result pages exist for the given URL.
-    # The following steps retrieve this number:
-    Code_with_number_of_results = str(BeautifulSoup(requests.get(URL).content, 'html.parser').find('div', class_="page search-results"))
-    if Code_with_number_of_results != "None":
-        Number_of_results_approx_position = Code_with_number_of_results.find('"per_page":20,"prev_page_url":null,"to":20,"total":')
-        Number_of_pages = math.ceil(int(Code_with_number_of_results[Number_of_results_approx_position + 51:].split("}")[0]) / 20)
-        # Once the number of pages is calculated, iterate through them to find company names.
-        # They will be used later to search for specific data for each company (in a dedicated URL).
-        for Page in range(1, Number_of_pages):
-        # for Page in range(1, 2):
-            print("Getting data from page " + str(Page))
-            try:
-                Soup = BeautifulSoup(requests.get(URL + "?page=" + str(Page + 1)).content, 'html.parser')
-                Page_content = str(Soup.find('div', class_="page search-results"))
-            except:
-                # If the first attempt to access fails, make a second attempt after a short wait.
-                try:
-                    # wait_with_random_delay(Delay)
-                    print("First attempt to read page " + str(Page) + " failed. Retrying...")
-                    Soup = BeautifulSoup(requests.get(URL + "?page=" + str(Page + 1)).content, 'html.parser')
-                    Page_content = str(Soup.find('div', class_="page search-results"))
-                    print("Second attempt succeeded!")
-                except Exception as e:
-                    Page_content = ""
-                    Log(f"Error reading page {Page}: {e}", True)
-                    Error_count = Error_count + 1
-            Company_page_list = Retrieve_company_page_list(Page_content, Page)
-            Data = pd.concat([Data, Company_page_list], axis=0)
-        # Remove columns of data from the web page that are not interesting
+async def Get_activity_data(company, content=None, record=None):
+    # The activity record of the company, or None if its /verksamhet page couldn't be fetched.
+    # As for Get_closure_data, only a failed request is worth another attempt of the company.
+    # content: the /verksamhet page when it has already been fetched; record: that of a previous attempt of the company.
+    global Error_count
+    if record is not None:
+        return record
+    name = company.jurnamn
+    activity_url = Detail_URLs(company)[0]
+    async with Parse_backlog:
         try:
-            Data = Data.drop(['ftgtyp', 'bolpres', 'companyPresentation', 'score', 'remarks', 'hasremarks', 'relatedmetadata', 'hasrelatedmetadata', 'status'], axis=1)
-        except:
-            Log("Column drop error at " + Unquoted_URL[6] + "/.../" + Unquoted_URL[-1], True)
-            Error_count = Error_count + 1
+            if content is None:
+                content = await Fetch_content(activity_url, keep_validators=True)
+        except Exception as e:
+            Log(f"Error retrieving activity data for {name}: {e}", False, logging.WARNING, orgnr=company.orgnr, url=activity_url)
+            return None
+        try:
+            return await Parse(Activity_parser, content, "activity-" + Activity_parser_name)
+        except Exception as e:
+            Log(f"Error reading activity data about {name}: {e}", True, logging.ERROR, orgnr=company.orgnr, url=activity_url)
+            Error_count += 1
+    return {}
+
+async def Get_company_row(company, activity_content=None, closure_content=None, activity_record=None, closure_cells=None):
+    # Fetch the two detail pages of a company (unless they're given, or already parsed by a previous attempt).
+    # Return its row, and the records of the two pages (see Company_retrieved): a retry of the company keeps those it has.
+    # The two pages are independent, so they're requested at the same time:
+    # a company costs a single round-trip instead of two in a row.
+    # The row is a preallocated buffer with a slot per column: the closure cells go straight into it.
+    global Count
+    company_row = New_company_row()
+    activity_record, closure_cells = await asyncio.gather(Get_activity_data(company, activity_content, activity_record),
+                                                          Get_closure_data(company, closure_content, closure_cells))
+    # The listing data, the activity data and the closure data make the row of the company complete
+    with Metrics.timer("merge_seconds"):
+        Fill_company_row(company_row, company.row())
+        Fill_company_row(company_row, activity_record or {})
+        if closure_cells is not None:
+            slots, values = closure_cells
+            company_row[slots] = values
+    complete = activity_record is not None and closure_cells is not None and len(closure_cells[0]) > 0
+    Metrics.inc("companies_total", outcome="complete" if complete else "incomplete")
+    Count = Count + 1
+    print(str(Count) + "\t\t" + company.jurnamn)
+    return company_row, (activity_record, closure_cells)
+
+def Company_retrieved(records):
+    # True if both detail pages of the company have been retrieved, or found unchanged by a delta crawl (records is None)
+    return records is None or all(record is not None for record in records)
+
+async def Get_delta_company_row(company):
+    # In a delta crawl, the detail pages are requested conditionally. When neither has changed since the last crawl,
+    # the company isn't parsed at all and its row is None. Otherwise the row is rebuilt from both pages,
+    # taking the unchanged one from the response cache when possible.
+    contents = []
+    changed = False
+    urls = Detail_URLs(company)
+    for url, content in zip(urls, await asyncio.gather(*[Fetch_if_changed(url) for url in urls], return_exceptions=True)):
+        if isinstance(content, Exception):
+            Log(f"Error in the conditional request of {url}: {content}", False, logging.WARNING, orgnr=company.orgnr, url=url)
+            Discard_validators([url])
+            contents.append(None)
+            changed = True
+            continue
+        if content is None and Cache is not None:
+            contents.append(Cache.get(url))
+        else:
+            contents.append(content)
+            changed = changed or content is not None
+    if not changed:
+        return None, None
+    return await Get_company_row(company, *contents)
+
+async def Get_changed_company_row(company):
+    # The row of a company and the records of its pages (see Get_company_row); in a delta crawl, both are None if the company hasn't changed
+    if Delta:
+        return await Get_delta_company_row(company)
+    return await Get_company_row(company)
+
+async def Process_company(company, rows, url, retries, attempt_number=1, records=None):
+    # Fetch the two detail pages of a company and put its complete row among the rows of the segment.
+    # Many companies run at the same time, but they all share the single event loop, so writing the rows is safe.
+    # A company whose pages fail goes to the retry queue of the segment, as long as the retry budget allows it,
+    # with the records of the pages that didn't fail (records): only the others are requested again.
+    # the last attempt writes whatever could be retrieved, except in a delta crawl, where a partial row would overwrite a complete one.
+    global Error_count
+    name = company.jurnamn
+    orgnr = company.orgnr
+    if attempt_number == 1 and not rows.claim(orgnr):
+        # The segment lists the company twice
+        Metrics.inc("duplicates_total")
+        return
+    journal_row = Journal.company_row(url, orgnr)
+    if journal_row is not None:
+        # The company was completed by a previous run: its row comes from the journal
+        rows.put(orgnr, name, journal_row)
+        return
+    if Journal.company_unchanged(url, orgnr):
+        return
+    if not Seen.claim(orgnr, url):
+        # The company is listed by another segment too, which fetches and writes it
+        Metrics.inc("duplicates_total")
+        return
+    if attempt_number == 1:
+        Retry_budget.attempt()
+    if records is None:
+        company_row, records = await Get_changed_company_row(company)
+    else:
+        company_row, records = await Get_company_row(company, activity_record=records[0], closure_cells=records[1])
+    if company_row is None:
+        Journal.mark_company(url, orgnr, UNCHANGED)
+        Metrics.inc("companies_total", outcome="unchanged")
+        Save_validators(Detail_URLs(company))
+        return
+    succeeded = Company_retrieved(records)
+    if not succeeded:
+        Discard_validators(Detail_URLs(company))
+        if attempt_number < MAX_ATTEMPTS and not Replay and Retry_budget.withdraw():
+            # When replaying from the cache, trying again doesn't make a missing response appear
+            Metrics.inc("retries_total", stage="company")
+            retries.push(company, attempt_number, records)
+            print(f"\t\t\tAttempt {attempt_number} to get data about {name} failed. It will be retried.")
+            return
+        Log(f"Data request error about {name} after {attempt_number} attempts", True, logging.ERROR, orgnr=orgnr, attempts=attempt_number)
+        Error_count += 1
+    if succeeded or not Delta:
+        with Metrics.timer("write_seconds"):
+            rows.put(orgnr, name, company_row)
+    # The finished company is committed right away; the failed ones will be fetched again by the next run
+    if succeeded:
+        Journal.mark_company(url, orgnr, DONE, json.dumps(company_row.tolist()))
+        Save_validators(Detail_URLs(company))
+    else:
+        Journal.mark_company(url, orgnr, FAILED)
+
+async def Get_company_page_list(url, page):
+    # The companies of a result page, read from the journal when a previous run has already fetched it
+    rows = Journal.page_rows(url, page)
+    if rows is not None:
+        return [ListingRecord.from_json(item) for item in rows]
+    try:
+        content = await Get_page_content(url, page)
+        company_page_list = await Parse(Parse_listing_page, content, "listing")
+    except Exception as e:
+        Log(f"Error retrieving page list at page {page} of {url}: {e}", True, logging.ERROR, url=url, page=page)
+        company_page_list = []
+    if not company_page_list and not Replay:
+        # A result page without companies is often the way the site answers when it's overloaded
+        Rate.decrease()
+    if company_page_list:
+        Journal.mark_page(url, page, DONE, json.dumps([company.to_json() for company in company_page_list]))
+        Journal.add_companies(url, [company.orgnr for company in company_page_list])
+    else:
+        Journal.mark_page(url, page, FAILED)
+    return company_page_list
+
+async def Prefetch_pages(url, pages, buffer):
+    # Worker of the pager: fetch the pages it takes from the shared iterator and put their companies in the buffer.
+    # The buffer is bounded, so the workers wait when the companies aren't consumed fast enough.
+    for page in pages:
+        try:
+            company_page_list = await Get_company_page_list(url, page)
+        except Exception as e:
+            Log(f"Error retrieving page list at page {page} of {url}: {e}", True, logging.ERROR, url=url, page=page)
+            company_page_list = []
+        await buffer.put(company_page_list)
+
+async def Listing_records(url, number_of_pages):
+    # Generator of the companies of a segment. The first page comes from the response that gave the number of results (see Number_of_results),
+    # the others are prefetched concurrently into a bounded buffer and handed over as soon as they arrive,
+    # so that the detail pages of their companies can be requested right away.
+    for company in await Get_company_page_list(url, 1):
+        yield company
+    if number_of_pages < 2:
+        return
+    buffer = asyncio.Queue(LISTING_BUFFER_PAGES)
+    pages = iter(range(2, number_of_pages + 1))
+    workers = [asyncio.ensure_future(Prefetch_pages(url, pages, buffer)) for _ in range(min(LISTING_PREFETCH_WORKERS, number_of_pages - 1))]
+    try:
+        for _ in range(number_of_pages - 1):
+            for company in await buffer.get():
+                yield company
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+async def Guard_company(company, url, coroutine):
+    # An unexpected error stays with its company: the company is recorded as failed, to be fetched again by the next run,
+    # while the rest of the segment, and the other segments, go on
+    global Error_count
+    try:
+        await coroutine
+    except Exception as e:
+        Log(f"Unexpected error processing {company.jurnamn}: {e!r}", True, logging.ERROR, orgnr=company.orgnr, url=url)
+        Error_count += 1
+        Journal.mark_company(url, company.orgnr, FAILED)
+
+def Start_company(company_tasks, in_flight, coroutine):
+    # The slot of in_flight taken by the caller is released when the company is finished
+    task = asyncio.ensure_future(coroutine)
+    company_tasks.add(task)
+    task.add_done_callback(company_tasks.discard)
+    task.add_done_callback(lambda _: in_flight.release())
+    return task
+
+async def Retry_companies(retries, rows, url, in_flight, company_tasks):
+    # Put the failed companies back into the segment as they become due, alongside the companies still coming from the pager
+    while True:
+        company, attempt_number, records = await retries.get()
+        await in_flight.acquire()
+        Start_company(company_tasks, in_flight,
+                      Guard_company(company, url, Process_company(company, rows, url, retries, attempt_number, records))).add_done_callback(
+            lambda _: retries.task_done())
+
+def Segment_name(url):
+    # Short description of a search for the file names: its (first) sector, then the values of the other facets, if any
+    parts = urllib.parse.unquote(url.split(SEARCH_PATH + "/", 1)[1]).split("/")
+    facets = list(zip(parts[0::2], parts[1::2]))
+    sectors = [value for key, value in facets if key == SECTOR_FACET]
+    others = [value for key, value in facets if key not in (SECTOR_FACET, COMPANY_TYPE_FACET)]
+    if not others:
+        others = [value for key, value in facets if key == COMPANY_TYPE_FACET]
+    name = sectors[0] + (f" +{len(sectors) - 1}" if len(sectors) > 1 else "") if sectors else "ALL"
+    return " - ".join([name, " ".join(others)] if others else [name])
+
+def Segment_filename(url):
+    return (DELTA_FILE_PREFIX if Delta else DATA_FILE_PREFIX) + Segment_name(url) + " - " + str(datetime.date.today().year) + str(
+        datetime.date.today().month) + str(datetime.date.today().day) + "-" + str(
+        datetime.datetime.today().hour) + str(datetime.datetime.today().minute) + str(
+        datetime.datetime.today().second) + OUTPUT_EXTENSIONS[Output_format]
+
+def Number_of_pages(number_of_results):
+    # The site doesn't show the results beyond the cap, whatever the number of pages
+    return math.ceil(min(number_of_results, RESULTS_CAP) / RESULTS_PER_PAGE)
 
-        # For each company in Data, visit the dedicated web page to integrate its data
-        Company_dataset = pd.DataFrame(columns=Company_dataset_columns)
-        Company_dataset = pd.concat([Company_dataset, Data], join="outer", ignore_index=True)
-        Company_dataset.index = Company_dataset["jurnamn"]
-        Company_dataset.drop(["jurnamn"], axis=1, inplace=True)
-        # Now, Company_dataset contains the basic data of a page of companies, with several columns related to exercises that need to be filled
-        for Company in Data.iterrows():
-            Count = Count + 1
-            Name = Company[1]["jurnamn"].replace("&amp;", "&")
-            Company_DF = pd.DataFrame(Company[1]).transpose()
-            Company_DF.index = [Name]
-            Company_DF.drop(["jurnamn"], axis=1, inplace=True)
-            Company_activity_data = Get_activity_data(Company, Delay)
-            Company_activity_data.set_index(Company_DF.index)
-            Company_activity_data.index = [Name]
-            # Assign the same index to Company_closure_data as the row with the same orgnr in Company_dataset:
-            Company_closure_data = Get_closure_data(Company, Delay)
-            Company_closure_data.columns = [Name]
-            # The content of Company_closure_data integrates Company_dataset, making it complete. To do this, you need to find the row
-            # of Company_dataset corresponding to it. This can be done, for example, by looking for the one that contains the same "orgnr".
+async def Process_URL(url):
+    global Error_count
+    if Journal.segment_done(url):
+        Log(f"{url} has already been written, according to the crawl journal. Skipping...", True)
+        return
+    Log("Processing " + url, True)
+    # First, determine how many result pages exist for the given URL (the partitioner has usually probed it already)
+    number_of_results = await Number_of_results(url)
+    if number_of_results is None:
+        Log(f"Unable to retrieve the number of results in {url}. Skipping...", True)
+        return
+    if number_of_results > RESULTS_CAP:
+        Log(f"{url} has {number_of_results} results: only the first {RESULTS_CAP} will be retrieved", True)
+    number_of_pages = Number_of_pages(number_of_results)
+    print(f"Getting data from {number_of_pages} pages")
+    # A resumed segment keeps the file name it was given when it was first started
+    filename = Journal.segment_filename(url)
+    if filename is None:
+        filename = Segment_filename(url)
+        Journal.mark_segment(url, PENDING, filename)
+    try:
+        with Create_segment_writer(RAW_DATA_FOLDER + filename, Company_dataset_columns) as writer:
+            # The pager prefetches the result pages while the companies already found are being fetched.
+            # Each company is scheduled as soon as its page arrives: the rate controller decides how many of them are actually on the network,
+            # and when too many are waiting the pager stops reading ahead.
+            # Each of them is written as soon as it's complete, so the memory used doesn't grow with the size of the segment.
+            # The failed companies wait in the retry queue meanwhile; the segment is complete when none of them is left.
+            in_flight = asyncio.Semaphore(MAX_COMPANIES_IN_FLIGHT)
+            rows = SegmentRows(writer)
+            company_tasks = set()
+            retries = RetryQueue()
+            retrier = asyncio.ensure_future(Retry_companies(retries, rows, url, in_flight, company_tasks))
             try:
-                print(str(Count) + "\t\t" + Name)
-                # This makes it easy to replace the content of Company_dataset with that of Company_closure_data and Company_activity_data:
-                Company_dataset.loc[Company_DF.index, :] = pd.concat([Company_DF, Company_activity_data, Company_closure_data.transpose()], axis=1)
-            except:
-                Log("Error merging data for " + Name, True)
-                Error_count = Error_count + 1
-        # Replace "&amp;", which may interfere with CSV generation
-        Company_dataset.replace({"&amp;": "&"}, regex=True, inplace=True)
-        
-        # Now that Final_dataset contains all the information for each company, it's time to write the result to a file
+                listed_tasks = []
+                async for company in Listing_records(url, number_of_pages):
+                    await in_flight.acquire()
+                    listed_tasks.append(Start_company(company_tasks, in_flight, Guard_company(company, url, Process_company(company, rows, url, retries))))
+                await asyncio.gather(*listed_tasks)
+                await retries.join()
+            finally:
+                retrier.cancel()
+            rows.flush()
+        # With failed pages or companies, the segment stays pending: the next run fetches them again and writes the file anew
+        failures = Journal.segment_failures(url)
+        if failures == 0:
+            Journal.mark_segment(url, DONE, filename)
+            Log(filename + " successfully written.", True)
+        else:
+            Log(f"{filename} written, but {failures} pages or companies failed: the next run will fetch them again", True, logging.WARNING)
+    except (OSError, UnicodeError):
+        Log("Write error of " + filename, True)
+        Error_count = Error_count + 1
+
+async def Process_segment(url, semaphore):
+    # The shards are balanced, so a few of them can be crawled side by side without one of them lagging far behind
+    async with semaphore:
+        await Process_URL(url)
+
+def Search_task(url):
+    return QueueTask(f"{SEARCH_TASK} {url}", SEARCH_TASK, url, {}, 0)
+
+def Page_task(url, page):
+    return QueueTask(f"{PAGE_TASK} {url} {page}", PAGE_TASK, url, {"page": page}, 0)
+
+def Company_task(url, company):
+    # The id doesn't depend on the shard: a company listed by several shards is published, fetched and collected only once,
+    # whichever worker finds it
+    return QueueTask(f"{COMPANY_TASK} {company.orgnr}", COMPANY_TASK, url, company.to_json(), 0)
+
+async def Run_task(queue, task):
+    # Execute a leased task: the search and page tasks publish the tasks they discover, the company tasks return the row of the company.
+    # A failed task goes back to the queue, to be tried again by any worker after the backoff delay (see Retry_delay),
+    # as long as it has attempts left and the retry budget allows it.
+    if task.attempts == 1:
+        Retry_budget.attempt()
+    try:
+        result = None
+        if task.kind == SEARCH_TASK:
+            number_of_results = await Number_of_results(task.url)
+            if number_of_results is None:
+                raise LookupError("unable to retrieve the number of results")
+            # The companies of the first page are already known from the same response
+            rows = Journal.page_rows(task.url, 1)
+            if rows is None:
+                queue.publish([Page_task(task.url, page) for page in range(1, Number_of_pages(number_of_results) + 1)])
+            else:
+                queue.publish([Company_task(task.url, ListingRecord.from_json(item)) for item in rows] +
+                              [Page_task(task.url, page) for page in range(2, Number_of_pages(number_of_results) + 1)])
+            result = number_of_results
+        elif task.kind == PAGE_TASK:
+            content = await Get_page_content(task.url, task.payload["page"])
+            company_page_list = await Parse(Parse_listing_page, content, "listing")
+            if not company_page_list:
+                Rate.decrease()
+                raise LookupError("no company in the page")
+            queue.publish([Company_task(task.url, company) for company in company_page_list])
+        else:
+            company = ListingRecord.from_json(task.payload)
+            company_row, records = await Get_changed_company_row(company)
+            if not Company_retrieved(records):
+                Discard_validators(Detail_URLs(company))
+                raise LookupError("incomplete company data")
+            if company_row is not None:
+                result = [company.jurnamn, company_row.tolist()]
+    except Exception as e:
+        Log(f"Task {task.id} failed at attempt {task.attempts}: {e}", False, logging.WARNING, task=task.id, attempt=task.attempts)
+        if task.attempts < MAX_ATTEMPTS and Retry_budget.withdraw():
+            Metrics.inc("retries_total", stage=task.kind)
+            queue.fail(task, time.time() + Retry_delay(task.attempts))
+        else:
+            queue.fail(task)
+        return
+    queue.complete(task, result)
+    if task.kind == COMPANY_TASK:
+        Save_validators(Detail_URLs(company))
+
+async def Work(queue):
+    # Lease tasks and run them until the queue is empty. The tasks leased by other workers are waited for,
+    # since they come back to the queue if their worker dies.
+    running = set()
+    while True:
+        if len(running) < QUEUE_LEASE_SIZE:
+            running |= {asyncio.ensure_future(Run_task(queue, task)) for task in queue.lease(QUEUE_LEASE_SIZE - len(running), VISIBILITY_TIMEOUT)}
+        if running:
+            _, running = await asyncio.wait(running, timeout=QUEUE_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            counts = queue.counts()
+            if counts[PENDING] == 0 and counts[LEASED] == 0:
+                Log(f"The task queue is empty: {counts[DONE]} tasks done, {counts[FAILED]} failed", True)
+                return
+            await asyncio.sleep(QUEUE_POLL_INTERVAL)
+
+def Collect_results(queue):
+    # Write the rows of the companies completed by all the workers, one raw data file per shard
+    global Error_count
+    for url in queue.segments(COMPANY_TASK):
+        filename = Segment_filename(url)
         try:
-            Filename = "Company_data " + Unquoted_URL[6] + " - " + Unquoted_URL[-1] + " - " + str(datetime.date.today().year) + str(
-                datetime.date.today().month) + str(datetime.date.today().day) + "-" + str(
-                datetime.datetime.today().hour) + str(datetime.datetime.today().minute) + str(
-                datetime.datetime.today().second) + ".csv"
-            Company_dataset.to_csv(RAW_DATA_FOLDER + Filename, sep=";", encoding="utf-16")
-            Log(Filename + " successfully written.", True)
-        except:
-            Log("CSV write error.", True)
+            with Create_segment_writer(RAW_DATA_FOLDER + filename, Company_dataset_columns) as writer:
+                rows = SegmentRows(writer)
+                for name, company_row in queue.results(COMPANY_TASK, url):
+                    company_row = Company_row_from_json(company_row)
+                    rows.put(company_row[Company_row_slots["orgnr"]], name, company_row)
+                rows.flush()
+            Log(filename + " successfully written.", True)
+        except (OSError, UnicodeError):
+            Log("Write error of " + filename, True)
             Error_count = Error_count + 1
-    else:
-        Log(f"Unable to retrieve the number of results in {URL}. Skipping...", True)
-Log("Error count = " + str(Error_count) + "\nTotal companies analyzed: " + str(Count), True)
-Log("**************** END ****************\n\n", False)
-# subprocess.run(["shutdown", "/h"])
\ No newline at end of file
+
+async def Run_queue(queue, urls, publish, collect):
+    if publish:
+        if urls is None:
+            urls = await Shard_URLs(ROOT_FACETS)
+        queue.publish([Search_task(url) for url in urls])
+        Log(f"{len(urls)} shards published to the task queue", True)
+    await Work(queue)
+    if collect:
+        Collect_results(queue)
+
+async def Crawl(urls, concurrency, http2=False, journal_path=CRAWL_JOURNAL, cache_folder=RESPONSE_CACHE_FOLDER, replay=False, replay_date=None,
+                activity_parser=ACTIVITY_PARSER, output_format=OUTPUT_FORMAT, queue_location=None, publish=False, collect=False,
+                delta=False, state_path=FETCH_STATE, metrics_textfile=METRICS_TEXTFILE, metrics_json=METRICS_JSON, seen_bloom=None,
+                parse_workers=PARSE_WORKERS, new_crawl=False):
+    # One event loop drives the whole crawl. Without a list of URLs, the whole search is first partitioned into shards.
+    # A few segments are processed at the same time, and the listing pages and the company pages inside each segment
+    # are fetched concurrently. With a task queue, this process is instead one of the workers of a shared crawl.
+    # A delta crawl writes only the companies whose detail pages have changed since the previous crawl.
+    # The pages are parsed by a pool of processes, fed by the fetchers through a bounded backlog.
+    # With replay, every response is read from the cache instead: a replayed run doesn't need to be resumed,
+    # so its journal lives in memory and doesn't interfere with the one of the real crawl.
+    # A journal is resumed until new_crawl asks for a fresh start.
+    global Rate, Session, Journal, Cache, Replay, Replay_date, Activity_parser, Activity_parser_name, Output_format, Delta, Fetch_state, Metrics, Seen
+    global Parse_pool, Parse_backlog, Retry_budget, Breakers
+    Rate = RateController(concurrency)
+    Retry_budget = RetryBudget(RETRY_BUDGET_MIN, RETRY_BUDGET_RATIO)
+    Breakers = {}
+    Metrics = CrawlMetrics()
+    Output_format = output_format
+    Replay = replay
+    Replay_date = replay_date
+    if activity_parser == "selectolax" and HTMLParser is None:
+        Log("The selectolax package is not installed. Using lxml to parse the activity pages.", True)
+        activity_parser = "lxml"
+    Activity_parser = ACTIVITY_PARSERS[activity_parser]
+    Activity_parser_name = activity_parser
+    Journal = CrawlJournal(":memory:" if replay else journal_path)
+    if new_crawl:
+        Journal.reset()
+        Log(f"New crawl: the crawl journal {journal_path} has been cleared", True)
+    elif Journal.segments_done() > 0:
+        Log(f"The crawl journal {journal_path} is resumed: its {Journal.segments_done()} segments already written will be skipped. "
+            "Use --new-crawl to start a new crawl.", True, logging.WARNING)
+    Seen = SeenCompanies(Journal, seen_bloom)
+    Delta = delta
+    # A replayed run doesn't update the state of the real crawls
+    Fetch_state = FetchState(state_path) if state_path is not None and not replay else None
+    Cache = ResponseCache(cache_folder) if cache_folder is not None else None
+    queue = Open_task_queue(queue_location) if queue_location is not None else None
+    Parse_pool = concurrent.futures.ProcessPoolExecutor(parse_workers) if parse_workers != 0 else None
+    Parse_backlog = asyncio.Semaphore(PARSE_BACKLOG_PAGES)
+    monitors = [asyncio.ensure_future(Monitor_rate()), asyncio.ensure_future(Monitor_metrics(metrics_textfile, metrics_json))]
+    try:
+        async with Create_session(concurrency, http2) as Session:
+            if queue is not None:
+                await Run_queue(queue, urls, publish, collect)
+                return
+            if urls is None:
+                urls = await Shard_URLs(ROOT_FACETS)
+            segment_semaphore = asyncio.Semaphore(PARALLEL_SEGMENTS)
+            await asyncio.gather(*[Process_segment(url, segment_semaphore) for url in urls])
+            if Delta and all(Journal.segment_done(url) for url in urls):
+                # The refresh is complete: the next one starts from scratch, with the validators of this one
+                Journal.reset()
+                Log(f"Delta crawl completed: the crawl journal {journal_path} has been cleared for the next refresh", True)
+    finally:
+        for monitor in monitors:
+            monitor.cancel()
+        Export_metrics(metrics_textfile, metrics_json)
+        if Parse_pool is not None:
+            Parse_pool.shutdown(cancel_futures=True)
+        if queue is not None:
+            queue.close()
+        Journal.close()
+        if Fetch_state is not None:
+            Fetch_state.close()
+        if Cache is not None:
+            Cache.close()
+
+
+
+
+# MAIN
+
+if __name__ == "__main__":
+    Parser = argparse.ArgumentParser(description="Scrape company data from allabolag.se")
+    Parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="maximum number of requests in flight at the same time")
+    Parser.add_argument("--http2", action="store_true", help="use the HTTP/2 transport (requires the h2 package)")
+    Parser.add_argument("--journal", help=f"SQLite crawl journal used to resume an interrupted run (default: '{CRAWL_JOURNAL}', "
+                        f"or '{DELTA_JOURNAL}' with --delta)")
+    Parser.add_argument("--cache", default=RESPONSE_CACHE_FOLDER, help="folder of the on-disk response cache")
+    Parser.add_argument("--no-cache", action="store_true", help="don't store the fetched responses")
+    Parser.add_argument("--replay", action="store_true", help="parse the responses stored in the cache instead of fetching them")
+    Parser.add_argument("--replay-date", help="replay the responses fetched on this date (YYYY-MM-DD), instead of the most recent ones")
+    Parser.add_argument("--activity-parser", choices=list(ACTIVITY_PARSERS), default=ACTIVITY_PARSER, help="parser of the /verksamhet pages")
+    Parser.add_argument("--url", action="append", dest="urls", help="crawl this search URL as it is, instead of partitioning the whole search (can be repeated)")
+    Parser.add_argument("--queue", nargs="?", const=TASK_QUEUE, help="work on a shared task queue: a SQLite file (default: %(const)s) "
+                        "or a redis:// URL for workers on several machines")
+    Parser.add_argument("--publish", action="store_true", help="with --queue, publish the shards of the search before working")
+    Parser.add_argument("--collect", action="store_true", help="with --queue, write the raw data files once the queue is empty")
+    Parser.add_argument("--delta", action="store_true", help="request the detail pages conditionally and write only the companies that have changed")
+    Parser.add_argument("--state", default=FETCH_STATE, help="SQLite file with the validators of the pages fetched by the previous crawls")
+    Parser.add_argument("--metrics-textfile", default=METRICS_TEXTFILE, help="Prometheus textfile with the metrics of the crawl ('' to disable)")
+    Parser.add_argument("--metrics-json", default=METRICS_JSON, help="JSON snapshot of the metrics of the crawl ('' to disable)")
+    Parser.add_argument("--new-crawl", action="store_true", help="clear the crawl journal and start a new crawl, instead of resuming the previous one")
+    Parser.add_argument("--seen-bloom", type=int, metavar="CAPACITY", help="keep the companies already met in a Bloom filter sized for "
+                        "this number of companies, instead of an in-memory set")
+    Parser.add_argument("--parse-workers", type=int, default=PARSE_WORKERS, help="processes parsing the pages "
+                        "(default: one per CPU core; 0 parses them in the event loop)")
+    Parser.add_argument("--format", choices=list(OUTPUT_EXTENSIONS), default=OUTPUT_FORMAT, help="format of the raw data files")
+    Arguments = Parser.parse_args()
+    if Arguments.replay and Arguments.no_cache:
+        Parser.error("--replay needs the response cache")
+    if (Arguments.publish or Arguments.collect) and Arguments.queue is None:
+        Parser.error("--publish and --collect need --queue")
+    if Arguments.queue is not None and Arguments.queue.startswith(("redis://", "rediss://", "unix://")) and redis is None:
+        Parser.error("a Redis task queue needs the redis package")
+    if Arguments.delta and Arguments.replay:
+        Parser.error("--delta can't be used with --replay")
+    if Arguments.format != "csv" and pa is None:
+        Parser.error(f"--format {Arguments.format} needs the pyarrow package")
+
+    Log("**************** BEGIN ****************", False)
+    Journal_path = Arguments.journal or (DELTA_JOURNAL if Arguments.delta else CRAWL_JOURNAL)
+    asyncio.run(Crawl(Arguments.urls, Arguments.concurrency, Arguments.http2, Journal_path,
+                      None if Arguments.no_cache else Arguments.cache, Arguments.replay, Arguments.replay_date, Arguments.activity_parser,
+                      Arguments.format, Arguments.queue, Arguments.publish, Arguments.collect, Arguments.delta, Arguments.state,
+                      Arguments.metrics_textfile, Arguments.metrics_json, Arguments.seen_bloom, Arguments.parse_workers,
+                      Arguments.new_crawl))
+    Log("Error count = " + str(Error_count) + "\nTotal companies analyzed: " + str(Count), True)
+    Log("**************** END ****************\n\n", False)
+    # subprocess.run(["shutdown", "/h"])